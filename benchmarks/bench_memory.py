@@ -0,0 +1,90 @@
+'''Память на одно сообщение: прежнее представление (исходные dict'ы Slack с blocks, reactions и т.д.,
+плюс добавленные user_realname и msg_datetime) и компактные Message с __slots__.
+
+Сообщения генерирует мок (benchmarks/mock_slack.py) - те же, что отдаёт его conversations.history.
+Память считается через tracemalloc: сколько занимает готовый список сообщений канала.
+
+Запуск: python benchmarks/bench_memory.py [--count 200000]'''
+import argparse
+import json
+import sys
+import tracemalloc
+from os.path import dirname, abspath
+
+BENCH_DIR = dirname(abspath(__file__))
+sys.path.insert(0, dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+import slack_history_downloader as shd  # noqa: E402
+from mock_slack import MockSlack  # noqa: E402
+
+
+def raw_lines(mock, count):
+    '''Строки JSONL-хранилища: сообщение с обсуждением и user_realname, как их пишет ChannelSync.commit_page'''
+    lines = []
+    for i in range(count):
+        msg = mock.message(i)
+        msg['user_realname'] = f'Юзер {int(msg["user"][1:])}'
+        if 'reply_count' in msg:
+            msg['thread_replies'] = [mock.reply(i, k) for k in range(1, mock.replies + 1)]
+            for reply in msg['thread_replies']:
+                reply['user_realname'] = f'Юзер {int(reply["user"][1:])}'
+        lines.append(json.dumps(msg, ensure_ascii=False).encode('utf-8'))
+    return lines
+
+
+def legacy_load(lines):
+    '''Прежнее представление: dict'ы целиком плюс строка с датой у каждого сообщения и ответа'''
+    messages = []
+    for line in lines:
+        msg = json.loads(line)
+        for m in [msg] + msg.get('thread_replies', []):
+            m['msg_datetime'] = shd.convert_ts_into_local_timezone(m['ts']).strftime('%Y.%m.%d %H:%M:%S')
+        messages.append(msg)
+    return messages
+
+
+def compact_load(lines):
+    messages = []
+    offset = 0
+    for line in lines:
+        messages.append(shd.Message(json.loads(line), offset))
+        offset += len(line) + 1
+    return messages
+
+
+def measure(load, lines):
+    '''Сколько байт занимает результат load(lines) и пик памяти во время загрузки'''
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    messages = load(lines)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current - before, peak - before, messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=200000, help='сколько сообщений в канале')
+    args = parser.parse_args()
+
+    mock = MockSlack(messages=args.count)
+    try:
+        lines = raw_lines(mock, args.count)
+    finally:
+        mock.server.server_close()  # сервер не запускали - только закрываем сокет
+    total = args.count + sum(line.count(b'"thread_ts"') - 1 for line in lines if b'"thread_replies"' in line)
+    print(f'Канал: {args.count} сообщений ({total} с ответами), '
+          f'JSONL {sum(len(line) + 1 for line in lines) / 1024 / 1024:.1f} МБ')
+
+    results = {}
+    for name, load in [('dict', legacy_load), ('Message', compact_load)]:
+        size, peak, messages = measure(load, lines)
+        results[name] = size
+        print(f'{name:8} {size / 1024 / 1024:8.1f} МБ  {size / total:6.0f} байт/сообщение  '
+              f'(пик при загрузке {peak / 1024 / 1024:.1f} МБ)')
+        del messages
+    print(f'Экономия: x{results["dict"] / results["Message"]:.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+'''Сравнение скорости форматирования текста сообщений: прежний многопроходный вариант
+(re.findall + str.replace для ссылок, пять re.sub для разметки, семь replace для пробелов)
+и однопроходный format_text.
+
+Запуск: python benchmarks/bench_mrkdwn.py [--count 200000] [--seed 1]'''
+import argparse
+import random
+import re
+import sys
+from os.path import dirname, abspath
+from time import perf_counter
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+import slack_history_downloader as shd  # noqa: E402
+
+
+WORDS = ['привет', 'сервер', 'deploy', 'ошибка', 'логи', 'test', 'релиз', 'база', 'очередь', 'snake_case_name']
+
+
+def legacy_format_text(text, users):
+    '''Форматирование в том виде, в каком оно было в html_one_message до однопроходного варианта'''
+    links = re.findall(r'<.*?>', text)
+    if links:
+        for link in links:
+            if link[1] == "@":
+                user_id = link[2:-1].split('|')[0]
+                text = text.replace(link, '@' + users.get(user_id, user_id))
+                continue
+            i_pipe = link.find("|")
+            if i_pipe != -1:
+                link_url = link[1 : i_pipe]
+                link_text = link[i_pipe+1 : -1]
+                text = text.replace(link, f'<a href="{link_url}">{link_text}</a>')
+            else:
+                text = text.replace(link, f'<a href="{link[1:-1]}">{link[1:-1]}</a>')
+
+    text = text.replace('\n', '<br>')
+    text = text.replace('\t', '  ')
+
+    d_replaces = {'```': 'pre', '`': 'code', '*': 'b', '_': 'i', '~': 's'}
+    for k in ['```', '`', '*', '_', '~']:
+        v = d_replaces[k]
+        if k in text:
+            text = re.sub(rf'(^|\s*|<br>)\{k}(.+?)\{k}(\s|$|<br>)', rf'\1<{v}>\2</{v}>\3', text)
+
+    for i_space in range(8, 1, -1):
+        text = text.replace(r' ' * i_space, '&nbsp;' * i_space)
+    return text
+
+
+def random_text(rnd, user_ids):
+    parts = []
+    for _ in range(rnd.randint(3, 40)):
+        kind = rnd.random()
+        word = rnd.choice(WORDS)
+        if kind < 0.55:
+            parts.append(word)
+        elif kind < 0.62:
+            parts.append(f'*{word}*')
+        elif kind < 0.67:
+            parts.append(f'_{word}_')
+        elif kind < 0.69:
+            parts.append(f'~{word}~')
+        elif kind < 0.73:
+            parts.append(f'`{word}`')
+        elif kind < 0.78:
+            parts.append(f'<@{rnd.choice(user_ids)}>')
+        elif kind < 0.83:
+            parts.append(f'<https://example.com/{word}?id={rnd.randint(1, 10**6)}|{word}>')
+        elif kind < 0.86:
+            parts.append(f'<https://example.com/{word}>')
+        elif kind < 0.92:
+            parts.append('\n')
+        elif kind < 0.95:
+            parts.append(' ' * rnd.randint(2, 10) + word)
+        elif kind < 0.97:
+            parts.append('\t' + word)
+        else:
+            parts.append(f'```{word} = 1\n    {word}()\n```')
+    return ' '.join(parts)
+
+
+def bench(func, corpus):
+    started = perf_counter()
+    result = [func(text) for text in corpus]
+    return perf_counter() - started, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=200000, help='сколько сообщений в корпусе')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    user_ids = [f'U{i:08d}' for i in range(500)]
+    shd.users.update({user_id: f'Юзер {i}' for i, user_id in enumerate(user_ids)})
+    corpus = [random_text(rnd, user_ids) for _ in range(args.count)]
+    total_mb = sum(len(text) for text in corpus) / 1024 / 1024
+    print(f'Корпус: {args.count} сообщений, {total_mb:.1f} МБ текста')
+
+    legacy_time, legacy_result = bench(lambda text: legacy_format_text(text, shd.users), corpus)
+    new_time, new_result = bench(shd.format_text, corpus)
+    differ = sum(1 for a, b in zip(legacy_result, new_result) if a != b)
+
+    print(f'Прежний вариант:  {legacy_time:8.2f} с  ({args.count / legacy_time:10.0f} сообщений/с)')
+    print(f'format_text:      {new_time:8.2f} с  ({args.count / new_time:10.0f} сообщений/с)')
+    print(f'Ускорение: x{legacy_time / new_time:.2f}')
+    print(f'Результат отличается у {differ} сообщений ({differ * 100 / args.count:.1f}%): '
+          f'прежний вариант ставил теги внутри ссылок, кода и слов_с_подчёркиваниями '
+          f'и не заменял серии длиннее 8 пробелов целиком')
+
+    # Повторный рендер даёт тот же результат - исходный текст не меняется
+    assert [shd.format_text(text) for text in corpus[:1000]] == new_result[:1000]
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,330 @@
+'''Локальный мок Slack API для бенчмарков без slack.com.
+
+Отвечает на conversations.info/list/history/replies и users.info/list, отдаёт файлы-прикрепления
+(с поддержкой Range) и фото юзеров (с ETag). Сообщения не хранятся, а генерируются по номеру,
+поэтому канал на миллион сообщений не занимает память. Можно добавить задержку ответа и
+случайные ответы 429 с Retry-After.
+
+Запуск отдельно: python benchmarks/mock_slack.py --messages 100000 --port 8765
+Из кода: server = MockSlack(messages=10000); server.start(); ...; server.stop()'''
+import argparse
+import json
+import random
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread, Lock
+from time import sleep
+from urllib.parse import urlparse, parse_qs
+
+
+BASE_TS = 1500000000  # время первого сообщения
+MESSAGE_INTERVAL = 600  # секунд между сообщениями
+WORDS = ['привет', 'сервер', 'deploy', 'ошибка', 'логи', 'test', 'релиз', 'база', 'очередь', 'инцидент']
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256  # по умолчанию 5 - одновременные подключения теряются и ждут повтора SYN секунду
+
+
+class MockSlack:
+    '''Параметры:
+    messages - сколько сообщений в каждом канале
+    channels - сколько каналов (C0000001, C0000002, ...)
+    users - сколько юзеров
+    thread_every, replies - у каждого thread_every-го сообщения обсуждение из replies ответов
+    mega_thread - у самого нового сообщения обсуждение из mega_thread ответов (0 - нет)
+    file_every, file_size - у каждого file_every-го сообщения файл file_size байт
+    latency - задержка (сек.) перед каждым ответом API
+    rate_429 - доля запросов к API, на которые отвечаем 429 с заголовком Retry-After: retry_after
+    page_limit - максимальный размер страницы, как у настоящего Slack'''
+
+    def __init__(self, messages=10000, channels=1, users=200, thread_every=20, replies=5, mega_thread=0,
+                 file_every=25, file_size=64 * 1024, latency=0.0, rate_429=0.0, retry_after=1,
+                 page_limit=1000, host='127.0.0.1', port=0, seed=1):
+        self.messages = messages
+        self.channels = channels
+        self.users = users
+        self.thread_every = thread_every
+        self.replies = replies
+        self.mega_thread = mega_thread
+        self.file_every = file_every
+        self.file_size = file_size
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.page_limit = page_limit
+        self.random = random.Random(seed)
+        self.lock = Lock()
+        self.requests_count = 0
+        self.throttled_count = 0
+        self.file_block = bytes(range(256)) * (file_size // 256 + 1)
+        self.server = MockServer((host, port), self.handler_class())
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def api_url(self):
+        return self.url + '/api'
+
+    def start(self):
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # Генерация данных ----------------------------------------------------------
+
+    def channel_ids(self):
+        return [f'C{i:07d}' for i in range(1, self.channels + 1)]
+
+    def user_id(self, i):
+        return f'U{i % self.users:07d}'
+
+    def message_ts(self, i):
+        return f'{BASE_TS + i * MESSAGE_INTERVAL}.{i % 1000000:06d}'
+
+    def message_index(self, ts):
+        return (int(float(ts)) - BASE_TS) // MESSAGE_INTERVAL
+
+    def message(self, i):
+        ts = self.message_ts(i)
+        word = WORDS[i % len(WORDS)]
+        text = (f'Сообщение {i}: *{word}* _{WORDS[(i * 7) % len(WORDS)]}_ <@{self.user_id(i * 31 + 1)}> '
+                f'<https://example.com/{word}/{i}|{word}> `{word}()`\nвторая строка  с пробелами')
+        msg = {
+            'type': 'message',
+            'ts': ts,
+            'user': self.user_id(i),
+            'client_msg_id': f'msg-{i}',
+            'text': text,
+            'team': 'T0000001',
+            # Как у настоящего Slack: тот же текст ещё раз в blocks, экспорт их не читает
+            'blocks': [{'type': 'rich_text', 'block_id': f'b{i}', 'elements': [
+                {'type': 'rich_text_section', 'elements': [{'type': 'text', 'text': text}]}]}],
+        }
+        if i % 10 == 0:
+            msg['reactions'] = [{'name': 'thumbsup', 'users': [self.user_id(i + 1), self.user_id(i + 2)], 'count': 2}]
+        reply_count = self.reply_count(i)
+        if reply_count:
+            msg['thread_ts'] = ts
+            msg['reply_count'] = reply_count
+            msg['latest_reply'] = self.reply_ts(i, reply_count)
+        if self.file_every and i % self.file_every == 0:
+            file_id = f'F{i:09d}'
+            msg['files'] = [{
+                'id': file_id,
+                'title': f'{word}_{i}.png',
+                'pretty_type': 'PNG',
+                'size': self.file_size,
+                'url_private': f'{self.url}/files/{file_id}/{word}_{i}.png',
+                'original_w': 640,
+                'original_h': 480,
+            }]
+        return msg
+
+    def reply_count(self, i):
+        '''Сколько ответов в обсуждении сообщения i (0 - обсуждения нет)'''
+        if self.mega_thread and i == self.messages - 1:
+            return self.mega_thread
+        if self.thread_every and i % self.thread_every == self.thread_every - 1:
+            return self.replies
+        return 0
+
+    def reply_ts(self, i, k):
+        return f'{BASE_TS + i * MESSAGE_INTERVAL + k}.{k:06d}'
+
+    def reply(self, i, k):
+        return {
+            'type': 'message',
+            'ts': self.reply_ts(i, k),
+            'thread_ts': self.message_ts(i),
+            'user': self.user_id(i + k),
+            'client_msg_id': f'reply-{i}-{k}',
+            'text': f'Ответ {k} на сообщение {i}',
+        }
+
+    def user(self, i):
+        user_id = self.user_id(i)
+        return {
+            'id': user_id,
+            'name': f'user{i}',
+            'real_name': f'Юзер {i}',
+            'profile': {'real_name': f'Юзер {i}', 'image_192': f'{self.url}/avatars/{i % 10}.png'},
+        }
+
+    # Методы API -----------------------------------------------------------------
+
+    def page(self, items_count, params, make_item, newest_first):
+        '''Страница [make_item(i)] по cursor (смещение) и limit'''
+        limit = min(int(params.get('limit') or 100), self.page_limit)
+        offset = int(params.get('cursor') or 0)
+        end = min(items_count, offset + limit)
+        indexes = range(offset, end)
+        if newest_first:
+            indexes = (items_count - 1 - i for i in indexes)
+        items = [make_item(i) for i in indexes]
+        next_cursor = str(end) if end < items_count else ''
+        return items, next_cursor
+
+    def conversations_history(self, params):
+        oldest = float(params.get('oldest') or 0)
+        latest = float(params.get('latest') or 0)
+        # Число сообщений новее oldest: сообщения идут с равным интервалом
+        first = 0
+        if oldest:
+            first = max(0, min(self.messages, int((oldest - BASE_TS) // MESSAGE_INTERVAL) + 1))
+        last = self.messages
+        if latest:
+            last = max(first, min(self.messages, int((latest - BASE_TS) // MESSAGE_INTERVAL)))
+        messages, next_cursor = self.page(last - first, params, lambda i: self.message(first + i), True)
+        return {'ok': True, 'messages': messages, 'has_more': bool(next_cursor),
+                'response_metadata': {'next_cursor': next_cursor}}
+
+    def conversations_replies(self, params):
+        i = self.message_index(params['ts'])
+        reply_count = self.reply_count(i)
+        if not reply_count:
+            return {'ok': True, 'messages': [self.message(i)], 'has_more': False}
+        # Первым идёт родительское сообщение, затем ответы
+        items, next_cursor = self.page(reply_count + 1, params,
+                                       lambda k: self.message(i) if k == 0 else self.reply(i, k), False)
+        return {'ok': True, 'messages': items, 'has_more': bool(next_cursor),
+                'response_metadata': {'next_cursor': next_cursor}}
+
+    def conversations_info(self, params):
+        if params.get('channel') not in self.channel_ids():
+            return {'ok': False, 'error': 'channel_not_found'}
+        return {'ok': True, 'channel': {'id': params['channel'], 'name': 'bench-' + params['channel'].lower()}}
+
+    def conversations_list(self, params):
+        channels = [{'id': channel_id, 'name': 'bench-' + channel_id.lower(), 'is_member': True}
+                    for channel_id in self.channel_ids()]
+        items, next_cursor = self.page(len(channels), params, lambda i: channels[i], False)
+        return {'ok': True, 'channels': items, 'response_metadata': {'next_cursor': next_cursor}}
+
+    def users_list(self, params):
+        items, next_cursor = self.page(self.users, params, self.user, False)
+        return {'ok': True, 'members': items, 'response_metadata': {'next_cursor': next_cursor}}
+
+    def users_info(self, params):
+        return {'ok': True, 'user': self.user(int(params['user'][1:]))}
+
+    def handler_class(self):
+        mock = self
+        methods = {
+            'conversations.history': self.conversations_history,
+            'conversations.replies': self.conversations_replies,
+            'conversations.info': self.conversations_info,
+            'conversations.list': self.conversations_list,
+            'users.list': self.users_list,
+            'users.info': self.users_info,
+        }
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True  # иначе заголовки и тело уходят двумя пакетами с задержкой ACK 40 мс
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_body(self, status, body, headers=()):
+                self.send_response(status)
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                if url.path.startswith('/api/'):
+                    self.api(url.path[len('/api/'):], params)
+                elif url.path.startswith('/files/'):
+                    self.file()
+                elif url.path.startswith('/avatars/'):
+                    self.avatar(url.path)
+                else:
+                    self.send_body(404, b'not found')
+
+            def api(self, method, params):
+                if mock.latency:
+                    sleep(mock.latency)
+                with mock.lock:
+                    mock.requests_count += 1
+                    throttle = mock.rate_429 and mock.random.random() < mock.rate_429
+                    if throttle:
+                        mock.throttled_count += 1
+                if throttle:
+                    self.send_body(429, b'{"ok": false, "error": "ratelimited"}',
+                                   [('Retry-After', str(mock.retry_after))])
+                    return
+                if method not in methods:
+                    result = {'ok': False, 'error': 'unknown_method'}
+                else:
+                    result = methods[method](params)
+                self.send_body(200, json.dumps(result, ensure_ascii=False).encode('utf-8'),
+                               [('Content-Type', 'application/json; charset=utf-8')])
+
+            def file(self):
+                size = mock.file_size
+                offset = 0
+                range_header = self.headers.get('Range')
+                if range_header and range_header.startswith('bytes='):
+                    offset = int(range_header[len('bytes='):].split('-')[0])
+                if offset >= size:
+                    self.send_body(416, b'', [('Content-Range', f'bytes */{size}')])
+                    return
+                body = mock.file_block[offset:size]
+                if offset:
+                    self.send_body(206, body, [('Content-Range', f'bytes {offset}-{size - 1}/{size}')])
+                else:
+                    self.send_body(200, body, [('Accept-Ranges', 'bytes')])
+
+            def avatar(self, path):
+                etag = '"' + path.rsplit('/', 1)[-1] + '"'
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_body(304, b'')
+                    return
+                self.send_body(200, (path * 100).encode('utf-8'), [('ETag', etag)])
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Локальный мок Slack API')
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--channels', type=int, default=1)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--thread-every', type=int, default=20)
+    parser.add_argument('--replies', type=int, default=5)
+    parser.add_argument('--mega-thread', type=int, default=0, help='ответов в обсуждении самого нового сообщения')
+    parser.add_argument('--file-every', type=int, default=25)
+    parser.add_argument('--file-size', type=int, default=64 * 1024)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--rate-429', type=float, default=0.0)
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    server = MockSlack(messages=args.messages, channels=args.channels, users=args.users,
+                       thread_every=args.thread_every, replies=args.replies, mega_thread=args.mega_thread,
+                       file_every=args.file_every,
+                       file_size=args.file_size, latency=args.latency, rate_429=args.rate_429,
+                       retry_after=args.retry_after, port=args.port)
+    print(f'Мок Slack API: {server.api_url} (каналы {", ".join(server.channel_ids())})', flush=True)
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+'''Бенчмарк выгрузки канала на локальном моке Slack API (benchmarks/mock_slack.py).
+
+Для каждого размера канала поднимает мок в отдельном процессе и выгружает канал в отдельном
+процессе (чтобы пиковая память считалась честно), затем печатает время по этапам, скорость
+(сообщений/с, МБ/с) и пиковую память.
+
+Запуск: python benchmarks/run_benchmark.py [--sizes 10000,100000,1000000] [--latency 0.01] [--rate-429 0.01]
+                                           [--engine sync,async] [--mega-thread 50000 --large-threads page]'''
+import argparse
+import json
+import subprocess
+import sys
+import tempfile
+from contextlib import redirect_stdout
+from os import chdir, devnull
+from os.path import dirname, abspath, join
+from time import perf_counter, sleep
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+BENCH_DIR = dirname(abspath(__file__))
+sys.path.insert(0, dirname(BENCH_DIR))
+
+STAGES = ['users', 'history', 'replies', 'files', 'avatars', 'render', 'search']
+
+
+def peak_memory_mb():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_export(args):
+    '''Выгрузка одного канала с мока; результат пишется в args.result как json'''
+    import slack_history_downloader as shd
+
+    shd.HOST = args.api
+    shd.limiter = shd.RateLimiter(tier_limits={tier: args.tier_limit for tier in shd.TIER_LIMITS})
+    chdir(args.output)
+
+    started = perf_counter()
+    with open(devnull, 'w', encoding='utf-8') as quiet, redirect_stdout(quiet):
+        channels, failed = shd.export_channels(['C0000001'], token='bench', parallel=1, workers=args.workers,
+                                               engine=args.engine, large_threads=args.large_threads)
+    wall_time = perf_counter() - started
+    if failed:
+        raise SystemExit(f'Выгрузка не удалась: {failed}')
+
+    stored, _ = shd.load_store('C0000001')
+    messages = list(stored.values())
+    channel_files = shd.collect_files(messages)
+    total_messages = len(messages) + sum(sum(1 for _ in shd.iter_replies(msg)) for msg in messages)
+    stages = shd.metrics.to_dict()['stages']
+    result = {
+        'engine': args.engine,
+        'messages': total_messages,
+        'files': len(channel_files),
+        'file_bytes': sum(f.size or 0 for f in channel_files),
+        'wall_time': wall_time,
+        'stages': {name: stages.get(name, 0.0) for name in STAGES},
+        'peak_memory_mb': peak_memory_mb(),
+        'throttled': shd.limiter.throttled_count,
+        'rate_limit_wait': shd.limiter.wait_time,
+        'metrics': shd.metrics.to_dict(),
+    }
+    with open(args.result, 'w', encoding='utf-8') as f:
+        json.dump(result, f)
+
+
+def run_size(args, size, port, engine):
+    '''Мок и выгрузка движком engine в отдельных процессах для канала из size сообщений'''
+    mock = subprocess.Popen(
+        [sys.executable, join(BENCH_DIR, 'mock_slack.py'), '--messages', str(size), '--port', str(port),
+         '--latency', str(args.latency), '--rate-429', str(args.rate_429), '--file-size', str(args.file_size),
+         '--mega-thread', str(args.mega_thread)],
+        stdout=subprocess.PIPE, text=True)
+    try:
+        mock.stdout.readline()  # мок напечатал адрес - значит слушает порт
+        with tempfile.TemporaryDirectory() as output:
+            result_filename = join(output, 'result.json')
+            subprocess.run(
+                [sys.executable, abspath(__file__), '--worker', '--api', f'http://127.0.0.1:{port}/api',
+                 '--output', output, '--result', result_filename, '--workers', str(args.workers),
+                 '--tier-limit', str(args.tier_limit), '--engine', engine, '--large-threads', args.large_threads],
+                check=True)
+            with open(result_filename, 'r', encoding='utf-8') as f:
+                return json.load(f)
+    finally:
+        mock.terminate()
+        mock.wait()
+        sleep(0.2)
+
+
+def print_result(size, result):
+    stages = result['stages']
+    history_time = stages['history'] or 1e-9
+    # Файлы качаются и html рендерится, пока листается история (PagePipeline): этапы files и render -
+    # только хвост после последней страницы, поэтому скорость файлов считаем от начала истории
+    files_time = stages['history'] + stages['files'] or 1e-9
+    print(f'\nКанал на {size} сообщений ({result["messages"]} с ответами, {result["files"]} файлов), '
+          f'движок {result["engine"]}')
+    for name in STAGES:
+        # Обсуждения качаются параллельно, пока листается история: их время сложено по потокам
+        note = ' (сумма по потокам, входит в history)' if name == 'replies' else ''
+        print(f'  {name:8} {stages[name]:9.2f} с{note}')
+    print(f'  {"всего":8} {result["wall_time"]:9.2f} с')
+    print(f'  история: {result["messages"] / history_time:10.0f} сообщений/с')
+    print(f'  файлы:   {result["file_bytes"] / 1024 / 1024 / files_time:10.1f} МБ/с')
+    print(f'  в целом: {result["messages"] / result["wall_time"]:10.0f} сообщений/с')
+    if result['peak_memory_mb'] is not None:
+        print(f'  пиковая память: {result["peak_memory_mb"]:.0f} МБ')
+    print(f'  ответов 429: {result["throttled"]}, ожидание лимитов: {result["rate_limit_wait"]:.1f} с')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='10000,100000,1000000', help='размеры каналов через запятую')
+    parser.add_argument('--latency', type=float, default=0.0, help='задержка ответа мока, сек.')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='доля ответов 429')
+    parser.add_argument('--file-size', type=int, default=64 * 1024)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--tier-limit', type=int, default=100000,
+                        help='лимит запросов в минуту для всех тиров (мок не ограничивает)')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--engine', default='sync', help="движки через запятую: sync, async")
+    parser.add_argument('--mega-thread', type=int, default=0,
+                        help='ответов в обсуждении самого нового сообщения (например, 50000)')
+    parser.add_argument('--large-threads', default='inline', choices=['inline', 'collapsed', 'page'],
+                        help='как выгрузка показывает обсуждения длиннее THREAD_INLINE_LIMIT')
+    parser.add_argument('--json', help='сохранить результаты в json-файл')
+    # Внутренние аргументы для процесса, который выгружает канал
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--api', help=argparse.SUPPRESS)
+    parser.add_argument('--output', help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_export(args)
+        return
+
+    results = {}
+    for size in (int(size) for size in args.sizes.split(',')):
+        for engine in args.engine.split(','):
+            results[f'{size}_{engine}'] = result = run_size(args, size, args.port, engine)
+            print_result(size, result)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,143 @@
 import json
 import re
+import random
+import asyncio
 import requests as req
 import zlib
-from os import makedirs, chdir
-from os.path import join, exists, splitext, dirname
-from datetime import datetime, timezone
-from time import sleep, time
+import hashlib
+import codecs
+import argparse
+import sys
+from os import makedirs, chdir, replace, fsync, link, remove, environ, stat, fdopen, close
+from os.path import join, exists, splitext, dirname, samefile, getsize, basename, abspath
+from shutil import copyfile, rmtree
+from tempfile import mkstemp
+from datetime import datetime, timezone, timedelta
+from time import sleep, time, perf_counter
 from functools import partial
+from itertools import islice
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+from threading import Lock, Thread, BoundedSemaphore
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing.dummy import Pool as ThreadPool
 from subprocess import Popen
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:  # Python < 3.9
+    ZoneInfo = None
+# Асинхронный движок (--engine async): aiohttp или httpx (с h2 - HTTP/2)
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+try:
+    import httpx
+except ImportError:
+    httpx = None
+try:
+    import h2
+except ImportError:
+    h2 = None
+try:
+    import pyarrow as pa  # выгрузка в Parquet (--parquet)
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
 
 
 # Consts
 TOKEN = ''
 HOST = 'https://slack.com/api'
 MESSAGES_PER_REQUEST = 600 # 600
-SLEEP_TIME = 0.4
+WORKER_THREADS = 8  # общий пул потоков для обсуждений и фото юзеров; столько же потоков качают файлы-прикрепления
+CHANNELS_PARALLEL = 2  # сколько каналов выгружаем одновременно
+CHANNEL_TYPES = 'public_channel,private_channel'  # какие каналы ищем через conversations.list
+CHANNELS_PER_REQUEST = 200
+MAX_RETRIES = 10  # сколько раз повторяем запрос при сетевых ошибках и ответах 5xx
+BACKOFF_BASE = 1  # начальная пауза (сек.) экспоненциального backoff, удваивается с каждой попыткой
+BACKOFF_MAX = 60
+
+# Лимиты Slack API: тир -> запросов в минуту (https://api.slack.com/docs/rate-limits)
+TIER_LIMITS = {1: 1, 2: 20, 3: 50, 4: 100}
+METHOD_TIERS = {
+    'conversations.history': 3,
+    'conversations.replies': 3,
+    'conversations.info': 3,
+    'conversations.list': 2,
+    'users.info': 4,
+    'users.list': 2,
+}
+DEFAULT_TIER = 3
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # границы гистограммы времени запросов, сек.
+STORE_FOLDER = 'store'  # локальное хранилище скачанной истории и состояния синхронизации
+RESYNC_WINDOW = 7 * 24 * 60 * 60  # сколько секунд истории перечитываем при повторном запуске
+FULL_SYNC_INTERVAL = 30 * 24 * 60 * 60  # раз в столько секунд история перечитывается целиком (None - никогда),
+                                        # чтобы найти новые ответы в обсуждениях старше RESYNC_WINDOW
+USERS_CACHE = join(STORE_FOLDER, 'users.json')  # справочник пользователей, общий для всех каналов
+USERS_CACHE_TTL = 24 * 60 * 60  # через сколько секунд справочник скачивается заново
+USERS_PER_REQUEST = 200
+AVATARS_FOLDER = join('users', 'avatars')  # фото юзеров, имя файла = sha256 содержимого
+AVATARS_MANIFEST = join(AVATARS_FOLDER, 'manifest.json')  # ссылка -> etag, last_modified, blob
+BLOBS_FOLDER = 'blobs'  # файлы-прикрепления всех каналов, имя файла = sha256 содержимого
+BLOBS_MANIFEST = join(BLOBS_FOLDER, 'manifest.json')  # id файла Slack -> sha256, size, mtime, blob
+THREAD_INLINE_LIMIT = 1000  # обсуждения длиннее не держим в памяти: ответы постранично пишутся в store/{канал}.threads/
+LARGE_THREADS = 'inline'  # как показывать такие обсуждения: 'inline' - как обычные, 'collapsed' - свёрнутыми,
+                          # 'page' - ссылкой на отдельную страницу {канал}_thread_{ts}.html
+PIPELINE_PAGES = 4  # страниц истории в очереди на запись и страниц, ждущих свои обсуждения; если их больше,
+                    # листание истории ждёт
+PIPELINE_FILES = 64  # сколько файлов канала одновременно отдано на скачивание, пока листается история
+FILE_RETRIES = 5  # сколько попыток даём каждому файлу
+FILE_TIMEOUT = 60  # таймаут (сек.) на соединение и на паузу между кусками файла
+CHUNK_SIZE = 1024 * 1024
+HTML_BUFFER_SIZE = 1024 * 1024  # буфер записи html-файла
+PAGE_MODE = None  # None - вся история в одном html; 'month' - страница на месяц; число N - страница на N сообщений
+TIMEZONE = None  # None - часовой пояс системы; иначе имя пояса ('Europe/Moscow', 'UTC'), в котором показываем время
+ENGINE = 'sync'  # 'sync' - requests и пул потоков; 'async' - asyncio (если нет ни aiohttp, ни httpx - sync)
+ASYNC_BACKEND = None  # 'aiohttp', 'httpx' или None - aiohttp, если установлен (быстрее), иначе httpx (умеет HTTP/2)
+ASYNC_KEEPALIVE = 30  # сколько секунд асинхронный движок держит простаивающее соединение
+SEARCH_INDEX = True  # строить поисковый индекс и страницу поиска {channel}_search.html
+SEARCH_DOCS_PER_SHARD = 1000  # сообщений в одном файле с текстами результатов
+SEARCH_BATCH = 100000  # через столько сообщений новые записи индекса сбрасываются на диск (ограничивает память)
+SEARCH_SNIPPET = 200  # символов текста сообщения в результатах поиска
+EXPORT_FORMATS = ()  # машиночитаемые выгрузки рядом с html: 'jsonl' - {channel}.jsonl, 'parquet' - {channel}.parquet
+EXPORT_BATCH = 50000  # строк в одной группе строк Parquet (и в памяти при записи)
+MONTH_NAMES = ['Январь', 'Февраль', 'Март', 'Апрель', 'Май', 'Июнь',
+               'Июль', 'Август', 'Сентябрь', 'Октябрь', 'Ноябрь', 'Декабрь']
 
 # globals
-files = []
-users = {}
+worker_pool = None  # общий ThreadPool текущего запуска (WORKER_THREADS потоков)
+files_pool = None  # ThreadPool для файлов-прикреплений: качаются, пока обсуждения в worker_pool ждут лимиты API
+async_slots = None  # asyncio.Semaphore асинхронного движка: сколько обсуждений и фото качаем одновременно
+file_slots = None  # asyncio.Semaphore асинхронного движка: сколько файлов-прикреплений качаем одновременно
+users = {}  # id -> имя
+user_images = {}  # id -> ссылка на фото
+users_lock = Lock()
+seen_users = set()  # юзеры, встреченные в этом запуске (для них скачиваем фото)
+avatars = None  # AvatarDownloader текущего запуска
+blob_store = None  # BlobStore текущего запуска
+export_tz = None  # tzinfo из TIMEZONE (None - часовой пояс системы)
+utc_offsets = {}  # сутки UTC (ts // 86400) -> смещение часового пояса в секундах (None - внутри был переход)
+day_labels = {}  # номер дня -> ('ГГГГ.ММ.ДД', 'ГГГГ-ММ', date)
+
+MENTION_RE = re.compile(r'<@([A-Z0-9]+)(?:\|[^>]*)?>')
+
+# Разметка Slack (mrkdwn) одним регулярным выражением: сканируем текст один раз,
+# каждое совпадение превращает в html функция format_token
+MRKDWN_RE = re.compile(r'''
+    ```(?P<pre>.+?)```                            # блок кода
+  | `(?P<code>[^`\n]+)`                           # код в строке
+  | <(?P<link>[^<>\n]+)>                          # ссылка, упоминание, канал
+  | (?<!\w)(?P<mark>[*_~])(?=\S)(?P<emph>[^\n]+?)(?<=\S)(?P=mark)(?!\w)  # жирный, курсив, зачёркнутый
+  | (?P<newline>\n)
+  | (?P<spaces>[ \t]*\t[ \t]*|[ ]{2,})             # табуляция и несколько пробелов подряд
+''', re.S | re.X)
+# Внутри кода форматирование не работает, только ссылки, переводы строк и пробелы
+MRKDWN_CODE_RE = re.compile(r'<(?P<link>[^<>\n]+)>|(?P<newline>\n)|(?P<spaces>[ \t]*\t[ \t]*|[ ]{2,})')
+MRKDWN_TAGS = {'*': 'b', '_': 'i', '~': 's'}
+SEARCH_TERM_RE = re.compile(r'\w{2,}')  # слова для поискового индекса (так же разбивает запрос страница поиска)
+LINK_RE = re.compile(r'<([^<>\n]+)>')
 
 
 class ChannelNotFoundException(Exception):
@@ -29,209 +147,1406 @@ class OtherException(Exception):
     pass
 
 
-def get_replies(ses, thread_ts, client_msg_id):
+class Channel:
+    '''Выгружаемый канал: id, имя для файлов и счётчик скачанных прикреплений'''
+
+    def __init__(self, channel_id, name):
+        self.id = channel_id
+        self.name = delete_windows_symbols(name)
+        self.files_folder = f'{self.name}_files'
+        self.downloaded_file_count = 0
+        self.files_total = 0  # сколько прикреплений отдано на скачивание (растёт, пока листается история)
+        self.search_page = None  # страница поиска, если для канала строится индекс
+        self.large_threads = LARGE_THREADS  # как показывать обсуждения длиннее THREAD_INLINE_LIMIT
+        self.lock = Lock()
+
+
+class File:
+    '''Файл-прикрепление: только поля, нужные для скачивания и html'''
+    __slots__ = ('id', 'url', 'title', 'pretty_type', 'size', 'original_w', 'original_h')
+
+    def __init__(self, j_file):
+        self.id = j_file['id']
+        self.url = j_file.get('url_private')  # None - файл удалён
+        self.title = j_file.get('title', '')
+        self.pretty_type = j_file.get('pretty_type')
+        self.size = j_file.get('size')
+        self.original_w = int(j_file['original_w']) if 'original_w' in j_file else None
+        self.original_h = int(j_file['original_h']) if 'original_h' in j_file else None
+
+
+class Message:
+    '''Сообщение в памяти: только то, что нужно для выгрузки. Исходный json (с blocks, reactions и т.д.)
+    лежит в хранилище канала, offset - смещение его строки в JSONL-файле. Ответы больших обсуждений
+    не загружаются: thread_file - файл хранилища с ними (см. iter_replies).
+    Id юзеров и имена интернируются, чтобы миллион сообщений ссылался на одни и те же строки'''
+    __slots__ = ('ts', 'user', 'user_name', 'text', 'files', 'replies', 'reply_count', 'thread_file',
+                 'latest_reply', 'offset')
+
+    def __init__(self, j, offset=None):
+        self.ts = j['ts']
+        self.user = sys.intern(j['user']) if 'user' in j else None
+        self.user_name = sys.intern(j['user_realname']) if 'user_realname' in j else None
+        self.text = j.get('text')
+        self.files = [File(j_file) for j_file in j['files']] if 'files' in j else None
+        self.replies = [Message(j_reply) for j_reply in j['thread_replies']] if 'thread_replies' in j else None
+        self.reply_count = j.get('reply_count')
+        self.thread_file = j.get('thread_file')
+        self.latest_reply = j.get('latest_reply')
+        self.offset = offset
+
+
+def backoff_seconds(attempt):
+    '''Пауза перед повтором после временной ошибки: экспоненциальная, со случайным разбросом'''
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+
+class RateLimiter:
+    '''Token bucket на каждый метод Slack API, общий для всех потоков и корутин.
+
+    Slack считает лимит тира отдельно для каждого метода, поэтому ведро у каждого метода своё:
+    оно пополняется со скоростью TIER_LIMITS[тир метода] запросов в минуту и вмещает
+    десятую часть минутного лимита, чтобы разрешать короткие всплески. Ответ 429 блокирует
+    только этот метод на время из заголовка Retry-After. Считает, сколько секунд потрачено
+    на ожидание и сколько было ответов 429'''
+
+    def __init__(self, tier_limits=TIER_LIMITS, method_tiers=METHOD_TIERS):
+        self.tier_limits = tier_limits
+        self.method_tiers = method_tiers
+        self.lock = Lock()
+        self.buckets = {}  # метод -> [токенов, время последнего пополнения]
+        self.blocked_until = {}  # метод -> время, до которого нельзя слать запросы (Retry-After)
+        self.wait_time = 0.0
+        self.backoff_time = 0.0
+        self.throttled_count = 0
+        self.retry_count = 0
+
+    def _reserve(self, method):
+        '''Забираем токен и возвращаем, сколько секунд надо подождать перед запросом.
+        Токенов может стать меньше нуля - это очередь уже зарезервированных запросов'''
+        tier = self.method_tiers.get(method, DEFAULT_TIER)
+        rate = self.tier_limits[tier] / 60
+        capacity = max(1.0, self.tier_limits[tier] / 10)
+        with self.lock:
+            now = time()
+            tokens, updated = self.buckets.get(method, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate) - 1
+            self.buckets[method] = (tokens, now)
+            delay = max(0.0, -tokens / rate, self.blocked_until.get(method, 0) - now)
+            self.wait_time += delay
+        return delay
+
+    def acquire(self, method):
+        delay = self._reserve(method)
+        if delay > 0:
+            sleep(delay)
+        return delay
+
+    async def acquire_async(self, method):
+        delay = self._reserve(method)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return delay
+
+    def penalize(self, method, retry_after):
+        '''Slack ответил 429: не шлём запросы этого метода retry_after секунд'''
+        with self.lock:
+            now = time()
+            self.blocked_until[method] = max(self.blocked_until.get(method, 0), now + retry_after)
+            self.buckets[method] = (0.0, now)
+            self.throttled_count += 1
+
+    def backoff_delay(self, attempt):
+        '''Пауза перед повтором запроса к API после временной ошибки (учитывается в summary)'''
+        delay = backoff_seconds(attempt)
+        with self.lock:
+            self.backoff_time += delay
+            self.retry_count += 1
+        return delay
+
+    def summary(self):
+        return (f'Ожидание из-за лимитов API: {self.wait_time:.1f} с, ответов 429: {self.throttled_count}, '
+                f'повторов после ошибок: {self.retry_count} ({self.backoff_time:.1f} с)')
+
+
+class AvatarDownloader:
+    '''Фоновая загрузка фото юзеров в пуле потоков, пока листается история.
+
+    Работает в общем пуле потоков. Одна и та же ссылка скачивается один раз за запуск. В манифесте по ссылке хранятся ETag
+    и Last-Modified, поэтому неизменившиеся фото проверяются условным запросом (ответ 304).
+    Фото лежат в AVATARS_FOLDER под именем sha256 содержимого, а users/<id> - жёсткая ссылка
+    на такой файл, так что одинаковые фото (например, стандартные) хранятся один раз'''
+
+    def __init__(self, ses, pool):
+        self.ses = ses
+        self.pool = pool
+        self.lock = Lock()
+        self.user_urls = {}  # id -> ссылка
+        self.url_results = {}  # ссылка -> AsyncResult с именем blob-файла
+        self.not_modified_count = 0
+        self.downloaded_count = 0
+        self.manifest = {}
+        makedirs(AVATARS_FOLDER, exist_ok=True)
+        if exists(AVATARS_MANIFEST):
+            with open(AVATARS_MANIFEST, 'r', encoding='utf-8') as f:
+                self.manifest = json.load(f)
+
+    def submit(self, user_id, url):
+        '''Фото юзера в очередь. Без пула (асинхронный движок) ссылки только копятся до join_async'''
+        with self.lock:
+            self.user_urls[user_id] = url
+            if url not in self.url_results:
+                self.url_results[url] = self.pool.apply_async(self.fetch, (url,)) if self.pool else None
+
+    def request_headers(self, url):
+        '''Запись манифеста для ссылки и заголовки условного запроса'''
+        with self.lock:
+            entry = dict(self.manifest.get(url, {}))
+        headers = {}
+        if entry.get('blob') and exists(entry['blob']):
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        return entry, headers
+
+    def fetch(self, url):
+        '''Скачиваем фото по ссылке, если оно изменилось. Возвращает путь к blob-файлу или None'''
+        entry, headers = self.request_headers(url)
+        try:
+            r = self.ses.get(url, headers=headers)
+        except Exception as e:
+            print(f'Не могу скачать фото {url}: {e}')
+            return entry.get('blob')
+        return self.save(url, entry, r)
+
+    async def fetch_async(self, client, url):
+        entry, headers = self.request_headers(url)
+        try:
+            async with async_slots:
+                r = await client.get(url, headers=headers)
+        except Exception as e:
+            print(f'Не могу скачать фото {url}: {e}')
+            return entry.get('blob')
+        return self.save(url, entry, r)
+
+    def save(self, url, entry, r):
+        '''Ответ на запрос фото (requests или асинхронного клиента) -> путь к blob-файлу'''
+        if r.status_code == 304:
+            with self.lock:
+                self.not_modified_count += 1
+            metrics.cache_hit('avatars')
+            return entry['blob']
+        if r.status_code != 200:
+            print(r)
+            print(f'Не могу скачать фото {url}')
+            return entry.get('blob')
+
+        metrics.cache_hit('avatars', False)
+        metrics.add_bytes('avatars', len(r.content))
+        blob = join(AVATARS_FOLDER, hashlib.sha256(r.content).hexdigest())
+        if not exists(blob):
+            # Одинаковые фото по разным ссылкам могут сохраняться одновременно - у каждой записи свой временный файл
+            fd, tmp = mkstemp(dir=AVATARS_FOLDER, suffix='.tmp')
+            with fdopen(fd, 'wb') as f:
+                f.write(r.content)
+            replace(tmp, blob)
+        with self.lock:
+            self.downloaded_count += 1
+            self.manifest[url] = {
+                'etag': r.headers.get('ETag'),
+                'last_modified': r.headers.get('Last-Modified'),
+                'blob': blob
+            }
+        return blob
+
+    def join(self):
+        '''Дожидаемся всех загрузок и раскладываем фото по users/<id>'''
+        self.link_users({url: res.get() for url, res in self.url_results.items()})
+
+    async def join_async(self, client):
+        '''Скачиваем накопленные фото одновременно в одном цикле событий и раскладываем по users/<id>'''
+        urls = list(self.url_results)
+        blobs = await asyncio.gather(*(self.fetch_async(client, url) for url in urls))
+        self.link_users(dict(zip(urls, blobs)))
+
+    def link_users(self, blobs):
+        '''Раскладываем фото по users/<id> (blobs: ссылка -> blob-файл) и сохраняем манифест'''
+        for user_id, url in self.user_urls.items():
+            blob = blobs[url]
+            if blob:
+                link_or_copy(blob, join('users', user_id))
+
+        with open(AVATARS_MANIFEST + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f, ensure_ascii=False)
+        replace(AVATARS_MANIFEST + '.tmp', AVATARS_MANIFEST)
+        print(f'Фото юзеров: скачано {self.downloaded_count}, не изменилось {self.not_modified_count}')
+
+
+def link_or_copy(src, dst):
+    '''Жёсткая ссылка dst -> src (или копия, если ФС не умеет ссылки). Существующий dst заменяется.
+    Временное имя у каждого вызова своё: один и тот же dst могут создавать несколько потоков'''
+    if exists(dst) and samefile(src, dst):
+        return
+    fd, tmp = mkstemp(dir=dirname(dst) or '.', prefix=basename(dst), suffix='.tmp')
+    close(fd)
+    remove(tmp)  # link не создаёт ссылку поверх существующего файла
+    try:
+        link(src, tmp)
+    except OSError:
+        copyfile(src, tmp)
+    replace(tmp, dst)
+
+
+def file_sha256(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(partial(f.read, CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class BlobStore:
+    '''Общее для всех каналов хранилище файлов-прикреплений.
+
+    Файл лежит в BLOBS_FOLDER один раз под именем sha256 содержимого, а {channel}_files/<id><ext> -
+    жёсткая ссылка на него (или копия, если ФС не умеет ссылки). В манифесте по id файла Slack
+    хранятся sha256, размер и mtime blob-файла: файл считается скачанным, только если он есть
+    в манифесте и размер совпал, а verify() по размеру и mtime быстро находит повреждённые файлы
+    и пересчитывает sha256 только у изменившихся'''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.manifest = {}
+        self.changed = False
+        makedirs(BLOBS_FOLDER, exist_ok=True)
+        if exists(BLOBS_MANIFEST):
+            with open(BLOBS_MANIFEST, 'r', encoding='utf-8') as f:
+                self.manifest = json.load(f)
+
+    def find(self, file_entry):
+        '''blob-файл для файла Slack или None, если его нет или размер не совпадает'''
+        with self.lock:
+            entry = self.manifest.get(file_entry.id)
+        if entry is None or (file_entry.size is not None and file_entry.size != entry['size']):
+            return None
+        try:
+            if stat(entry['blob']).st_size != entry['size']:
+                return None
+        except OSError:
+            return None
+        return entry['blob']
+
+    def add(self, file_entry, filename):
+        '''Скачанный целиком filename переносим в хранилище (если такого содержимого ещё нет) и
+        записываем в манифест. Возвращает путь к blob-файлу'''
+        digest = file_sha256(filename)
+        blob = join(BLOBS_FOLDER, digest[:2], digest)
+        makedirs(dirname(blob), exist_ok=True)
+        if exists(blob) and getsize(blob) == getsize(filename):
+            remove(filename)  # то же содержимое под другим id или из другого канала
+        else:
+            replace(filename, blob)
+        self.record(file_entry.id, digest, blob)
+        return blob
+
+    def adopt(self, file_entry, filename):
+        '''Файл, скачанный в папку канала до появления хранилища: если размер совпал - заводим
+        на него blob-файл (жёсткой ссылкой). Возвращает путь к blob-файлу или None'''
+        if file_entry.size is not None and getsize(filename) != file_entry.size:
+            return None
+        digest = file_sha256(filename)
+        blob = join(BLOBS_FOLDER, digest[:2], digest)
+        makedirs(dirname(blob), exist_ok=True)
+        if not exists(blob):
+            link_or_copy(filename, blob)
+        self.record(file_entry.id, digest, blob)
+        return blob
+
+    def record(self, file_id, digest, blob):
+        st = stat(blob)
+        with self.lock:
+            links = self.manifest.get(file_id, {}).get('links', [])
+            self.manifest[file_id] = {'sha256': digest, 'size': st.st_size, 'mtime': st.st_mtime, 'blob': blob,
+                                      'links': links}
+            self.changed = True
+
+    def link(self, file_entry, blob, filename):
+        '''filename - ссылка на blob-файл. Путь запоминаем в манифесте, чтобы verify() удалил её
+        вместе с повреждённым blob-файлом'''
+        link_or_copy(blob, filename)
+        with self.lock:
+            links = self.manifest[file_entry.id]['links']
+            if filename not in links:
+                links.append(filename)
+                self.changed = True
+
+    def save(self):
+        with self.lock:
+            if not self.changed:
+                return
+            with open(BLOBS_MANIFEST + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(self.manifest, f, ensure_ascii=False)
+            replace(BLOBS_MANIFEST + '.tmp', BLOBS_MANIFEST)
+            self.changed = False
+
+    def check_blob(self, blob, entry, full):
+        '''Ошибка blob-файла (строкой) или None. sha256 считаем, только если изменились размер или mtime
+        (или full)'''
+        try:
+            st = stat(blob)
+        except OSError:
+            return 'отсутствует'
+        if st.st_size != entry['size']:
+            return f'размер {st.st_size} вместо {entry["size"]}'
+        if full or st.st_mtime != entry['mtime']:
+            if file_sha256(blob) != entry['sha256']:
+                return 'sha256 не совпадает'
+            entry['mtime'] = st.st_mtime
+        return None
+
+    def verify(self, full=False, workers=WORKER_THREADS):
+        '''Проверка хранилища по манифесту. Повреждённые blob-файлы и ссылки на них в папках каналов
+        удаляются, а их записи - из манифеста, так что следующая выгрузка скачает эти файлы заново.
+        Возвращает {id файла: ошибка}'''
+        by_blob = {}
+        for file_id, entry in self.manifest.items():
+            by_blob.setdefault(entry['blob'], []).append(file_id)
+
+        def check(item):
+            blob, file_ids = item
+            return blob, file_ids, self.check_blob(blob, self.manifest[file_ids[0]], full)
+
+        bad = {}
+        pool = ThreadPool(workers)
+        try:
+            for blob, file_ids, error in pool.imap_unordered(check, by_blob.items()):
+                if error is None:
+                    continue
+                print(f'{blob} ({", ".join(file_ids)}): {error}')
+                for file_id in file_ids:
+                    bad[file_id] = error
+                    for filename in self.manifest[file_id].get('links', []):
+                        if exists(filename):
+                            remove(filename)
+                if exists(blob):
+                    remove(blob)
+        finally:
+            pool.terminate()
+
+        with self.lock:
+            for file_id in bad:
+                del self.manifest[file_id]
+            self.changed = True
+        self.save()
+        print(f'Проверено файлов: {len(by_blob)}, повреждено или отсутствует: {len(bad)}')
+        return bad
+
+
+class Metrics:
+    '''Метрики запуска: число и гистограмма времени запросов по методам API, скачанные байты,
+    время ожидания лимитов, попадания в кэши (юзеры, обсуждения, файлы, фото) и время этапов.
+    Этап replies - время скачивания обсуждений, сложенное по всем потокам и задачам: обсуждения
+    качаются, пока листается история, поэтому оно входит в history и может быть больше его.
+
+    Хуки (add_hook) получают каждое событие сразу: hook(event, name, value), где event -
+    'request', 'bytes', 'rate_limited', 'cache_hit', 'cache_miss' или 'stage'.
+    В конце запуска метрики выгружаются через to_json() или to_prometheus()'''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.hooks = []
+        self.requests = {}  # метод -> {'count', 'sum', 'buckets', 'statuses'}
+        self.bytes = {}  # 'files' / 'avatars' -> байт
+        self.rate_limited = {}  # метод -> секунд ожидания
+        self.cache = {}  # кэш -> [попаданий, промахов]
+        self.stages = {}  # этап -> секунд (этапы разных каналов суммируются)
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def emit(self, event, name, value):
+        for hook in self.hooks:
+            hook(event, name, value)
+
+    def observe_request(self, method, seconds, status):
+        with self.lock:
+            method_stats = self.requests.setdefault(
+                method, {'count': 0, 'sum': 0.0, 'buckets': [0] * len(LATENCY_BUCKETS), 'statuses': {}})
+            method_stats['count'] += 1
+            method_stats['sum'] += seconds
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    method_stats['buckets'][i] += 1
+            method_stats['statuses'][str(status)] = method_stats['statuses'].get(str(status), 0) + 1
+        self.emit('request', method, seconds)
+
+    def add_bytes(self, kind, count):
+        with self.lock:
+            self.bytes[kind] = self.bytes.get(kind, 0) + count
+        self.emit('bytes', kind, count)
+
+    def add_rate_limited(self, method, seconds):
+        with self.lock:
+            self.rate_limited[method] = self.rate_limited.get(method, 0.0) + seconds
+        self.emit('rate_limited', method, seconds)
+
+    def cache_hit(self, name, hit=True):
+        with self.lock:
+            counts = self.cache.setdefault(name, [0, 0])
+            counts[0 if hit else 1] += 1
+        self.emit('cache_hit' if hit else 'cache_miss', name, 1)
+
+    @contextmanager
+    def stage(self, name):
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            seconds = perf_counter() - started
+            with self.lock:
+                self.stages[name] = self.stages.get(name, 0.0) + seconds
+            self.emit('stage', name, seconds)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'requests': {method: dict(method_stats,
+                                          buckets=dict(zip(map(str, LATENCY_BUCKETS), method_stats['buckets'])))
+                             for method, method_stats in self.requests.items()},
+                'bytes': dict(self.bytes),
+                'rate_limited_seconds': dict(self.rate_limited),
+                'throttled': limiter.throttled_count,
+                'retries': limiter.retry_count,
+                'cache': {name: {'hits': hits, 'misses': misses, 'hit_rate': hits / ((hits + misses) or 1)}
+                          for name, (hits, misses) in self.cache.items()},
+                'stages': dict(self.stages),
+            }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), ensure_ascii=False, indent=4)
+
+    def to_prometheus(self):
+        '''Метрики в текстовом формате Prometheus (для node_exporter textfile collector)'''
+        d = self.to_dict()
+        lines = [
+            '# HELP slack_export_request_seconds Время запросов к Slack API',
+            '# TYPE slack_export_request_seconds histogram',
+        ]
+        for method, method_stats in sorted(d['requests'].items()):
+            for bound, count in method_stats['buckets'].items():
+                lines.append(f'slack_export_request_seconds_bucket{{method="{method}",le="{bound}"}} {count}')
+            lines.append(f'slack_export_request_seconds_bucket{{method="{method}",le="+Inf"}} '
+                         f'{method_stats["count"]}')
+            lines.append(f'slack_export_request_seconds_sum{{method="{method}"}} {method_stats["sum"]:.6f}')
+            lines.append(f'slack_export_request_seconds_count{{method="{method}"}} {method_stats["count"]}')
+        lines += ['# HELP slack_export_bytes_total Скачано байт', '# TYPE slack_export_bytes_total counter']
+        lines += [f'slack_export_bytes_total{{kind="{kind}"}} {count}' for kind, count in sorted(d['bytes'].items())]
+        lines += ['# HELP slack_export_rate_limited_seconds_total Ожидание лимитов API',
+                  '# TYPE slack_export_rate_limited_seconds_total counter']
+        lines += [f'slack_export_rate_limited_seconds_total{{method="{method}"}} {seconds:.3f}'
+                  for method, seconds in sorted(d['rate_limited_seconds'].items())]
+        lines += ['# TYPE slack_export_throttled_total counter', f'slack_export_throttled_total {d["throttled"]}',
+                  '# TYPE slack_export_retries_total counter', f'slack_export_retries_total {d["retries"]}']
+        lines += ['# HELP slack_export_cache_requests_total Обращения к кэшам',
+                  '# TYPE slack_export_cache_requests_total counter']
+        for name, counts in sorted(d['cache'].items()):
+            lines.append(f'slack_export_cache_requests_total{{cache="{name}",result="hit"}} {counts["hits"]}')
+            lines.append(f'slack_export_cache_requests_total{{cache="{name}",result="miss"}} {counts["misses"]}')
+        lines += ['# HELP slack_export_stage_seconds Время этапов выгрузки', '# TYPE slack_export_stage_seconds gauge']
+        lines += [f'slack_export_stage_seconds{{stage="{name}"}} {seconds:.3f}'
+                  for name, seconds in sorted(d['stages'].items())]
+        return '\n'.join(lines) + '\n'
+
+
+def retry_after_seconds(r):
+    '''Время из заголовка Retry-After, если его нет - 30 секунд'''
+    try:
+        return float(r.headers.get('Retry-After', 30))
+    except ValueError:
+        return 30.0
+
+
+def next_page_cursor(j):
+    return j.get('response_metadata', {}).get('next_cursor', '') if j.get('has_more') else ''
+
+
+def iter_reply_pages(ses, channel_id, thread_ts, client_msg_id):
+    '''Страницы ответов обсуждения. Родительское сообщение (оно приходит первым) отбрасываем по ходу'''
     params = {
-        'channel': CHANNEL,
+        'channel': channel_id,
         'limit': MESSAGES_PER_REQUEST,
         'ts': thread_ts
     }
-
-    replies = get_messages(ses, 'conversations.replies', params, client_msg_id, False)
-
-    # Удаляем первое сообщение, т.к. оно равно самому сообщению вне ответов
-    for repl_i in range(len(replies)):
-        msg = replies[repl_i]
-        if msg['ts'] == thread_ts:
-            del replies[repl_i]
+    while True:
+        j = http_get(ses, 'conversations.replies', params)
+        prepare_page(j['messages'], channel_id, client_msg_id, fetch_threads=False)
+        yield [msg for msg in j['messages'] if msg['ts'] != thread_ts]
+        next_cursor = next_page_cursor(j)
+        if not next_cursor:
             break
+        params['cursor'] = next_cursor
 
+
+def get_replies(ses, channel_id, thread_ts, client_msg_id):
+    '''Ответы обсуждения по времени, без родительского сообщения'''
+    replies = []
+    with metrics.stage('replies'):
+        for page in iter_reply_pages(ses, channel_id, thread_ts, client_msg_id):
+            replies.extend(page)
+    replies.sort(key=lambda msg: msg['ts'])
     return replies
 
 
+def is_large_thread(msg):
+    return int(msg.get('reply_count', 0)) > THREAD_INLINE_LIMIT
+
+
+def thread_path(channel_id, thread_ts):
+    return join(STORE_FOLDER, f'{channel_id}.threads', f'{thread_ts}.jsonl')
+
+
+def write_replies(f, replies):
+    for msg in replies:
+        f.write(json.dumps(msg, ensure_ascii=False).encode('utf-8') + b'\n')
+
+
+@contextmanager
+def thread_writer(channel_id, thread_ts):
+    '''Файл большого обсуждения для записи: пишется во временный файл, который заменяет прежний,
+    только когда записаны все страницы'''
+    filename = thread_path(channel_id, thread_ts)
+    makedirs(dirname(filename), exist_ok=True)
+    with open(filename + '.tmp', 'wb') as f:
+        yield f
+    replace(filename + '.tmp', filename)
+
+
+def save_thread(ses, channel_id, thread_ts, client_msg_id):
+    '''Большое обсуждение (больше THREAD_INLINE_LIMIT ответов) постранично пишем в свой файл хранилища,
+    не собирая ответы в памяти. Slack отдаёт ответы от старых к новым. Возвращает путь к файлу'''
+    with metrics.stage('replies'), thread_writer(channel_id, thread_ts) as f:
+        for page in iter_reply_pages(ses, channel_id, thread_ts, client_msg_id):
+            write_replies(f, page)
+    return thread_path(channel_id, thread_ts)
+
+
+def iter_thread_file(filename):
+    '''Ответы большого обсуждения из файла хранилища, по одному'''
+    if not exists(filename):
+        return
+    with open(filename, 'rb') as f:
+        for line in f:
+            yield Message(json.loads(line))
+
+
+def iter_replies(msg):
+    '''Ответы обсуждения сообщения: из памяти или, у больших обсуждений, по одному из файла хранилища'''
+    if msg.replies is not None:
+        return iter(msg.replies)
+    if msg.thread_file is not None:
+        return iter_thread_file(msg.thread_file)
+    return iter(())
+
+
+def api_retry_delay(method, attempt, seconds, r=None, error=None):
+    '''Разбираем ответ r (или ошибку запроса error) на попытке attempt запроса к API method.
+    None - ответ годен, 0 - повторить сразу (429: паузу выдержит limiter), иначе пауза перед
+    повтором. Если попытки кончились - исключение. Общее для http_get и http_get_async'''
+    metrics.observe_request(method, seconds, 'error' if error is not None else r.status_code)
+    if error is not None:
+        if attempt >= MAX_RETRIES:
+            raise error
+        delay = limiter.backoff_delay(attempt)
+        print(f'Возникла ошибка при запросе {HOST}/{method}: {error!r}')
+        print(f'Спим {delay:.1f} секунд...')
+        return delay
+
+    if r.status_code == 429:
+        retry_after = retry_after_seconds(r)
+        print(f'Слишком много запросов к {method}. Ждём {retry_after:.0f} секунд...')
+        limiter.penalize(method, retry_after)
+        return 0
+
+    if r.status_code != 200:
+        print('Status code =', r.status_code)
+        if attempt >= MAX_RETRIES:
+            raise OtherException(f'HTTP {r.status_code} при запросе {method}')
+        delay = limiter.backoff_delay(attempt)
+        print(f'Retry in {delay:.1f} seconds...')
+        return delay
+    return None
+
+
 def http_get(ses, method, params):
+    attempt = 0
     while True:
+        waited = limiter.acquire(method)
+        if waited:
+            metrics.add_rate_limited(method, waited)
+        started = perf_counter()
+        r = error = None
         try:
             r = ses.get(f'{HOST}/{method}', params=params)
         except Exception as e:
-            print(f'Возникла ошибка при запросе {HOST}/{method}:')
-            print(e)
-            print('Спим 30 секунд...')
-            sleep(30)
-            continue
+            error = e
+        delay = api_retry_delay(method, attempt, perf_counter() - started, r, error)
+        if delay is None:
+            return slack_json(r)
+        if delay:
+            attempt += 1
+            sleep(delay)
+
+
+def slack_json(r):
+    '''Json ответа Slack API (requests или асинхронного клиента), ошибки Slack - исключениями'''
+    j = r.json()
+    if not j['ok']:
+        if j['error'] == 'channel_not_found':
+            raise ChannelNotFoundException('Slack error: ' + j['error'])
+        else:
+            raise OtherException('Slack error: ' + j['error'])
 
-        if r.status_code != 200:
-            print('Status code =', r.status_code)
-            if r.status_code == 429:
-                print('Слишком много запросов. Спим 30 секунд...')
-                sleep(30)
-                continue
-            else:
-                print('Retry in 30 seconds...')
-                sleep(30)
+    return j
 
-        j = r.json()
-        if not j['ok']:
-            if j['error'] == 'channel_not_found':
-                raise ChannelNotFoundException('Slack error: ' + j['error'])
-            else:
-                raise OtherException('Slack error: ' + j['error'])
 
-        return j
+def set_timezone(name):
+    '''Часовой пояс, в котором показываем время (None - пояс системы). Сбрасывает кэши смещений и дней'''
+    global export_tz
+    if name is None:
+        export_tz = None
+    elif name.upper() == 'UTC':
+        export_tz = timezone.utc
+    elif ZoneInfo is None:
+        raise OtherException('Для часового пояса нужен Python 3.9+ (модуль zoneinfo)')
+    else:
+        export_tz = ZoneInfo(name)
+    utc_offsets.clear()
+    day_labels.clear()
+
+
+def utc_offset(seconds):
+    '''Смещение часового пояса выгрузки от UTC (в секундах) в момент seconds'''
+    dt = datetime.fromtimestamp(seconds, export_tz or timezone.utc)
+    if export_tz is None:
+        dt = dt.astimezone()
+    return int(dt.utcoffset().total_seconds())
+
+
+def parse_ts(ts):
+    '''Slack ts ('1500000000.000100', бывает и без дробной части) -> целые секунды UTC'''
+    return int(ts.partition('.')[0])
+
+
+def ts_micros(ts):
+    '''Slack ts -> микросекунды UTC (для колонки time в Parquet)'''
+    seconds, _, fraction = ts.partition('.')
+    return int(seconds) * 1000000 + int(fraction[:6].ljust(6, '0'))
+
+
+def local_seconds(ts):
+    '''Секунды по часам часового пояса выгрузки. Смещение пояса считается один раз на сутки UTC
+    (по началу и концу суток); в сутки перехода на летнее время - для каждого сообщения отдельно'''
+    seconds = parse_ts(ts)
+    utc_day = seconds // 86400
+    offset = utc_offsets.get(utc_day, False)
+    if offset is False:
+        offset = utc_offset(utc_day * 86400)
+        if offset != utc_offset(utc_day * 86400 + 86399):
+            offset = None
+        utc_offsets[utc_day] = offset
+    if offset is None:
+        offset = utc_offset(seconds)
+    return seconds + offset
+
+
+def day_key(ts):
+    '''Номер дня сообщения в часовом поясе выгрузки - для группировки и прогресса без datetime'''
+    return local_seconds(ts) // 86400
+
+
+def day_label(day):
+    '''('ГГГГ.ММ.ДД', 'ГГГГ-ММ', date) дня day_key, форматируется один раз на день'''
+    label = day_labels.get(day)
+    if label is None:
+        date = (datetime(1970, 1, 1) + timedelta(days=day)).date()
+        label = day_labels[day] = (date.strftime('%Y.%m.%d'), date.strftime('%Y-%m'), date)
+    return label
+
+
+def format_ts(ts):
+    '''ts -> 'ГГГГ.ММ.ДД ЧЧ:ММ:СС' в часовом поясе выгрузки'''
+    seconds = local_seconds(ts)
+    day, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return f'{day_label(day)[0]} {hours:02d}:{minutes:02d}:{seconds:02d}'
 
 
 def convert_ts_into_local_timezone(ts):
-    '''Конвертирует timestamp ts в датувремя, но с прибавленным часовым поясом системы'''
-
-    if '.' in ts:
-        l = ts.split('.')
-        if len(l) != 2:
-            raise ValueError('Invalid time stamp')
-    dt = datetime.utcfromtimestamp(int(l[0])).replace(tzinfo=timezone.utc)
-    dt = dt.astimezone()
+    '''Конвертирует timestamp ts в датувремя в часовом поясе выгрузки (по умолчанию - системы)'''
+    dt = datetime.fromtimestamp(parse_ts(ts), export_tz or timezone.utc)
+    if export_tz is None:
+        dt = dt.astimezone()
     return dt
 
 
-def get_user_from_slack(user_id):
-    '''Получаем юзера из базы Слака, и заносим его в глобальный список'''
-
-    j_user = http_get(ses, 'users.info', {'user': user_id})['user']
+def add_user(j_user):
+    '''Заносим юзера из ответа users.info / users.list в глобальные списки'''
+    profile = j_user.get('profile', {})
     if 'real_name' in j_user:
-        users[user_id] = j_user['real_name']
-    elif 'profile' in j_user and 'real_name' in j_user['profile']:
-        users[user_id] = j_user['profile']['real_name']
-    elif 'profile' in j_user and 'display_name' in j_user['profile']:
-        users[user_id] = j_user['profile']['display_name']
-    
-    # Скачаем фото юзера, если нету
-    makedirs('users', exist_ok=True)
-    user_filename = join('users', user_id)
-    if not exists(user_filename):
-        if 'image_192' in j_user['profile']:  # image_original
-            r = ses_users.get(str(j_user['profile']['image_192']))
-            if r.status_code != 200:
-                print(r)
-                print(j_user['profile']['image_192'])
-                print(f'Не могу скачать фото юзера {users[user_id]} id: {user_id}')
-            else:
-                with open(user_filename, 'wb') as userfile:
-                    userfile.write(r.content)
+        name = j_user['real_name']
+    elif 'real_name' in profile:
+        name = profile['real_name']
+    elif 'display_name' in profile:
+        name = profile['display_name']
+    else:
+        name = j_user.get('name', j_user['id'])
+
+    with users_lock:
+        users[j_user['id']] = name
+        if 'image_192' in profile:  # image_original
+            user_images[j_user['id']] = str(profile['image_192'])
+
+
+def load_users_cache():
+    '''Загружаем справочник пользователей с диска. Возвращает True, если он не старше USERS_CACHE_TTL'''
+    if not exists(USERS_CACHE):
+        return False
+    try:
+        with open(USERS_CACHE, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+    except ValueError:
+        return False
 
+    with users_lock:
+        for user_id, user in cache['users'].items():
+            users[user_id] = user['name']
+            if user.get('image'):
+                user_images[user_id] = user['image']
+    return time() - cache['fetched'] < USERS_CACHE_TTL
 
-def get_messages(ses, method, params, client_msg_id=None, do_print=True):
-    '''Основная процедура, получаем json сообщений, обрабатываем их'''
-    cursor = ''
-    messages = []
-    current_date = 0
-    msgs_count = 0
-    global files
-    global users
 
+def save_users_cache(fetched=None):
+    '''Сохраняем справочник пользователей. fetched - когда справочник целиком скачан через users.list'''
+    if fetched is None and exists(USERS_CACHE):
+        try:
+            with open(USERS_CACHE, 'r', encoding='utf-8') as f:
+                fetched = json.load(f)['fetched']
+        except ValueError:
+            pass
+
+    with users_lock:
+        cache = {
+            'fetched': fetched or 0,
+            'users': {user_id: {'name': name, 'image': user_images.get(user_id)}
+                      for user_id, name in users.items()}
+        }
+    makedirs(STORE_FOLDER, exist_ok=True)
+    with open(USERS_CACHE + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(cache, f, ensure_ascii=False)
+    replace(USERS_CACHE + '.tmp', USERS_CACHE)
+
+
+def prefetch_users(ses):
+    '''Заполняем users до скачивания истории: из кэша на диске, а если он устарел -
+    постранично через users.list. Так не нужен отдельный users.info на каждого юзера'''
+    if load_users_cache():
+        metrics.cache_hit('users_directory')
+        print(f'Справочник пользователей загружен из кэша ({len(users)})')
+        return
+    metrics.cache_hit('users_directory', False)
+
+    params = {'limit': USERS_PER_REQUEST}
     while True:
-        if cursor: 
-            params.update(cursor=cursor)
+        j = http_get(ses, 'users.list', params)
+        for j_user in j['members']:
+            add_user(j_user)
 
-        j = http_get(ses, method, params)
-        sleep(SLEEP_TIME)
-
-        # Запомним за какой день обрабатываем сообщения
-        if len(j['messages']) > 0:
-            msgs_count += len(j['messages'])
-            current_date = j['messages'][0]['ts']
-            current_date = convert_ts_into_local_timezone(current_date).date()
+        next_cursor = j.get('response_metadata', {}).get('next_cursor', '')
+        if not next_cursor:
+            break
+        params['cursor'] = next_cursor
 
-        for msg in j['messages']:
-            # Пропускаем, если зашли сюда из get_replies и обрабатываем родительское сообщение
-            if 'client_msg_id' in msg and (msg['client_msg_id'] == client_msg_id):
-                continue
+    save_users_cache(fetched=time())
+    print(f'Скачали справочник пользователей ({len(users)})')
 
-            # Заходим в "обсуждение" сообщения, достаём все сообщения оттуда, добавляем в само сообщение
-            if 'reply_count' in msg:
-                if int(msg['reply_count']) > 0:
-                    thread_replies = get_replies(ses, msg['thread_ts'],  msg['client_msg_id'])
-                    msg['thread_replies'] = thread_replies
 
-            # Найдём понятное имя юзера
-            if 'user' in msg:
-                if msg['user'] not in users:
-                    get_user_from_slack(msg['user'])
-                    
-                msg['user_realname'] = users[msg['user']]
+def get_user_from_slack(user_id):
+    '''Получаем юзера из базы Слака, и заносим его в глобальный список.
+    Нужен только для тех, кого нет в users.list (например, юзеры из других воркспейсов)'''
 
-            # Заносим в сообщение человекочитаемое датавремя
-            msg_datetime = convert_ts_into_local_timezone(msg['ts'])
-            msg['msg_datetime'] = msg_datetime.strftime('%Y.%m.%d %H:%M:%S')
+    j_user = http_get(ses, 'users.info', {'user': user_id})['user']
+    add_user(j_user)
+
+
+def resolve_user(user_id):
+    '''Имя юзера по id. Незнакомых спрашиваем у Слака, фото встреченных впервые отдаём на фоновую загрузку'''
+    metrics.cache_hit('users', user_id in users)
+    if user_id not in users:
+        get_user_from_slack(user_id)
+    with users_lock:
+        is_new = user_id not in seen_users
+        seen_users.add(user_id)
+    if is_new and avatars and user_id in user_images:
+        avatars.submit(user_id, user_images[user_id])
+    return users[user_id]
+
+
+def resolve_mentions(text):
+    '''Заранее узнаём имена упомянутых в тексте юзеров, чтобы при создании html не ходить в сеть'''
+    for user_id in MENTION_RE.findall(text):
+        metrics.cache_hit('users', user_id in users)
+        if user_id not in users:
+            get_user_from_slack(user_id)
+
+
+def store_paths(channel_id):
+    '''Пути к файлу сообщений (JSONL) и файлу состояния синхронизации канала'''
+    return (join(STORE_FOLDER, f'{channel_id}.jsonl'),
+            join(STORE_FOLDER, f'{channel_id}.state.json'))
+
+
+def load_state(channel_id):
+    '''Состояние синхронизации: latest_ts - самое новое сохранённое сообщение,
+    cursor и oldest - незавершённый запуск, с которого надо продолжить'''
+    state_filename = store_paths(channel_id)[1]
+    if not exists(state_filename):
+        return {}
+    with open(state_filename, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_state(channel_id, state):
+    '''Атомарно записываем состояние (через временный файл), чтобы падение не оставило битый json'''
+    makedirs(STORE_FOLDER, exist_ok=True)
+    state_filename = store_paths(channel_id)[1]
+    with open(state_filename + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False)
+        f.flush()
+        fsync(f.fileno())
+    replace(state_filename + '.tmp', state_filename)
+
+
+def append_to_store(channel_id, messages):
+    '''Дописываем страницу сообщений в конец JSONL-файла канала. Возвращает смещения записанных строк'''
+    makedirs(STORE_FOLDER, exist_ok=True)
+    offsets = []
+    with open(store_paths(channel_id)[0], 'ab') as f:
+        for msg in messages:
+            offsets.append(f.tell())
+            f.write(json.dumps(msg, ensure_ascii=False).encode('utf-8') + b'\n')
+        f.flush()
+        fsync(f.fileno())
+    return offsets
+
+
+def read_stored_json(channel_id, offset):
+    '''Исходный json сообщения из хранилища по смещению его строки'''
+    with open(store_paths(channel_id)[0], 'rb') as f:
+        f.seek(offset)
+        return json.loads(f.readline())
+
+
+def load_store(channel_id):
+    '''Читаем все сохранённые сообщения канала. Более поздняя запись того же ts заменяет раннюю.
+    Недописанный после аварийного завершения хвост файла обрезается, чтобы следующая страница
+    не склеилась с ним в одну строку. Возвращает словарь ts -> Message и количество строк в файле'''
+    stored = {}
+    lines_count = 0
+    store_filename = store_paths(channel_id)[0]
+    if not exists(store_filename):
+        return stored, lines_count
+
+    offset = 0
+    good_end = 0  # конец последней целой строки
+    with open(store_filename, 'rb') as f:
+        for line in f:
+            line_offset = offset
+            offset += len(line)
+            if not line.endswith(b'\n'):
+                break  # недописанная последняя строка
+            if not line.strip():
+                good_end = offset
+                continue
+            try:
+                j = json.loads(line)
+            except ValueError:
+                continue  # битая строка в середине - следующие строки целые
+            stored[j['ts']] = Message(j, line_offset)
+            lines_count += 1
+            good_end = offset
+    if offset > good_end:
+        print(f'{channel_id}: обрезаем недописанный конец хранилища ({offset - good_end} байт)')
+        with open(store_filename, 'r+b') as f:
+            f.truncate(good_end)
+    return stored, lines_count
+
+
+def compact_store(channel_id, stored):
+    '''Перезаписываем JSONL без дубликатов, которые накопились при перечитывании RESYNC_WINDOW.
+    Строки копируются как есть (остаются только последние записи каждого ts), смещения в stored обновляются'''
+    store_filename = store_paths(channel_id)[0]
+    by_offset = {msg.offset: msg for msg in stored.values()}
+    offset = 0
+    with open(store_filename, 'rb') as src, open(store_filename + '.tmp', 'wb') as f:
+        for line in src:
+            msg = by_offset.get(offset)
+            offset += len(line)
+            if msg is not None:
+                msg.offset = f.tell()
+                f.write(line)
+        f.flush()
+        fsync(f.fileno())
+    replace(store_filename + '.tmp', store_filename)
+
+
+class ChannelSync:
+    '''Инкрементальная синхронизация канала с локальным хранилищем.
+
+    Первый запуск скачивает всю историю. Следующие запрашивают conversations.history с oldest=
+    (последнее сохранённое сообщение минус RESYNC_WINDOW), так что докачиваются только новые
+    сообщения и обсуждения, у которых изменился latest_reply. Новый ответ в обсуждении сообщения
+    старше RESYNC_WINDOW так не увидеть, поэтому раз в FULL_SYNC_INTERVAL (или при full=True)
+    история листается целиком - неизменившиеся обсуждения и тогда берутся из хранилища.
+    После каждой страницы курсор сохраняется в состояние, и прерванный запуск продолжается
+    с последней записанной страницы.
+
+    params - параметры первого запроса conversations.history, stored - сохранённые сообщения (ts -> Message),
+    commit_page(messages, next_cursor) - записать очередную страницу, finish() - все сообщения по времени.
+    Выгрузка каналов передаёт страницы в commit_page через конвейер (PagePipeline)'''
+
+    def __init__(self, channel_id, full=False):
+        self.channel_id = channel_id
+        self.stored, self.lines_count = load_store(channel_id)
+        self.state = load_state(channel_id)
+
+        self.params = {
+            'channel': channel_id,
+            'limit': MESSAGES_PER_REQUEST
+        }
+        full_sync_ts = self.state.get('full_sync_ts')
+        if self.state.get('cursor'):
+            print('Продолжаем прерванное скачивание...')
+            self.params['cursor'] = self.state['cursor']
+            oldest = self.state.get('oldest')
+        elif not self.state.get('latest_ts'):
+            oldest = None
+        elif full or (FULL_SYNC_INTERVAL is not None
+                      and (not full_sync_ts or time() - full_sync_ts > FULL_SYNC_INTERVAL)):
+            print('Перечитываем всю историю, чтобы найти новые ответы в старых обсуждениях')
+            oldest = None
+        else:
+            oldest = '{:.6f}'.format(float(self.state['latest_ts']) - RESYNC_WINDOW)
+        if oldest:
+            self.params['oldest'] = oldest
+            print(f'Скачиваем сообщения, начиная с {day_label(day_key(oldest))[2]}')
+        self.state['oldest'] = oldest
+
+    def commit_page(self, page_messages, next_cursor):
+        '''Записываем страницу и курсор следующей. Возвращает записанные сообщения (Message)'''
+        offsets = append_to_store(self.channel_id, page_messages)
+        self.lines_count += len(page_messages)
+        messages = [Message(msg, offset) for msg, offset in zip(page_messages, offsets)]
+        for msg in messages:
+            self.stored[msg.ts] = msg
+        self.state['cursor'] = next_cursor
+        save_state(self.channel_id, self.state)
+        return messages
+
+    def finish(self):
+        if self.stored:
+            self.state['latest_ts'] = max(self.stored, key=float)
+        if self.state['oldest'] is None:
+            self.state['full_sync_ts'] = time()
+        self.state['cursor'] = None
+        self.state['oldest'] = None
+        save_state(self.channel_id, self.state)
+
+        if self.lines_count > len(self.stored) * 1.5:
+            compact_store(self.channel_id, self.stored)
+
+        messages = list(self.stored.values())
+        messages.sort(key=lambda msg: msg.ts)
+        return messages
+
+
+class PagePipeline:
+    '''Конвейер выгрузки канала: файлы и html готовятся, пока листается история.
+
+    Страницы из get_messages (on_page=put) идут в очередь из PIPELINE_PAGES страниц. Поток-потребитель
+    записывает каждую в хранилище (ChannelSync.commit_page), сразу отдаёт её файлы на скачивание
+    (submit, не больше PIPELINE_FILES одновременно) и рендерит html её сообщений во временный файл,
+    так что после последней страницы html собирается из готовых кусков (iter_html).
+    Если очередь или слоты файлов заняты, листание истории ждёт, и память не растёт.
+
+    submit(file_entry, done) - начать скачивание файла и вызвать done() по его окончании
+    (None - файлы не качаем). Порядок: put... close(), sync.finish(), finish(messages), render, discard()'''
+
+    def __init__(self, sync, channel, submit=None):
+        self.sync = sync
+        self.channel = channel
+        self.submit = submit
+        self.queue = Queue(PIPELINE_PAGES)
+        self.file_slots = BoundedSemaphore(PIPELINE_FILES)
+        self.file_ids = set()
+        self.error = None
+        if submit is not None:
+            makedirs(channel.files_folder, exist_ok=True)
+        makedirs(STORE_FOLDER, exist_ok=True)
+        self.spool_filename = join(STORE_FOLDER, f'{channel.id}.spool.html')
+        self.spool = open(self.spool_filename, 'w+b')
+        self.spooled = {}  # ts -> (смещение, длина) html сообщения в spool
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, page_messages, next_cursor):
+        '''on_page для get_messages: страница в очередь (ждёт, если очередь полна)'''
+        if self.error is not None:
+            raise self.error
+        self.queue.put((page_messages, next_cursor))
+
+    def run(self):
+        while True:
+            page = self.queue.get()
+            if page is None:
+                return
+            if self.error is not None:
+                continue  # после ошибки только разбираем очередь, чтобы put не ждал вечно
+            try:
+                self.consume(*page)
+            except Exception as e:
+                self.error = e
+
+    def consume(self, page_messages, next_cursor):
+        messages = self.sync.commit_page(page_messages, next_cursor)
+        self.download(collect_files(messages))
+        for msg in messages:
+            # Пишем кусками, а не одной строкой: у больших обсуждений html на десятки мегабайт
+            offset = self.spool.tell()
+            self.spool.writelines(piece.encode('utf-8') for piece in iter_message_body(self.channel, msg))
+            self.spooled[msg.ts] = (offset, self.spool.tell() - offset)
+
+    def download(self, files):
+        '''Файлы на скачивание, каждый один раз. Ждёт, если заняты все PIPELINE_FILES слотов'''
+        if self.submit is None:
+            return
+        for file_entry in files:
+            if file_entry.id in self.file_ids:
+                continue
+            self.file_ids.add(file_entry.id)
+            with self.channel.lock:
+                self.channel.files_total += 1
+            self.file_slots.acquire()
+            try:
+                self.submit(file_entry, self.file_slots.release)
+            except Exception:
+                self.file_slots.release()
+                raise
+
+    def close(self):
+        '''Дожидаемся, пока потребитель разберёт очередь. Его ошибка - исключением'''
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def finish(self, messages):
+        '''Файлы сообщений, которых не было в новых страницах (проверяются по хранилищу файлов),
+        и ожидание всех скачиваний'''
+        self.download(collect_files(msg for msg in messages if msg.ts not in self.spooled))
+        for _ in range(PIPELINE_FILES):
+            self.file_slots.acquire()
+        for _ in range(PIPELINE_FILES):
+            self.file_slots.release()
+
+    def iter_html(self, channel, msg, idx):
+        '''iter_message_html, но готовый html сообщения берётся из spool'''
+        spooled = self.spooled.get(msg.ts)
+        if spooled is None:
+            yield from iter_message_html(channel, msg, idx)
+            return
+        offset, length = spooled
+        self.spool.seek(offset)
+        yield f'<div class="message default clearfix" id="message{idx}">\n'
+        decoder = codecs.getincrementaldecoder('utf-8')()  # кусок может разрезать символ пополам
+        while length > 0:
+            chunk = self.spool.read(min(length, HTML_BUFFER_SIZE))
+            length -= len(chunk)
+            yield decoder.decode(chunk, final=length <= 0)
+
+    def discard(self):
+        self.spool.close()
+        remove(self.spool_filename)
+
+
+def collect_files(messages):
+    '''Все файлы из сообщений и их обсуждений'''
+    result = []
+    for msg in messages:
+        if msg.files:
+            result.extend(msg.files)
+        if msg.replies or msg.thread_file:
+            result.extend(collect_files(iter_replies(msg)))
+    return result
+
+
+def prepare_page(page_messages, channel_id, client_msg_id=None, known=None, fetch_threads=True):
+    '''Обработка страницы сообщений: имена авторов и упомянутых юзеров, ответы неизменившихся обсуждений
+    из хранилища (known). Возвращает сообщения, обсуждения которых надо скачать'''
+    threads = []
+    for msg in page_messages:
+        # Пропускаем, если зашли сюда из get_replies и обрабатываем родительское сообщение
+        if 'client_msg_id' in msg and (msg['client_msg_id'] == client_msg_id):
+            continue
 
-            if do_print:
-                msgdate = msg_datetime.date()
-                if current_date != msgdate:
-                    print(f"Скачали сообщения c {msgdate} по {current_date}...")
-                    current_date = msgdate
+        # Заходим в "обсуждение" сообщения, достаём все сообщения оттуда, добавляем в само сообщение
+        if 'reply_count' in msg:
+            if int(msg['reply_count']) > 0:
+                # Обсуждение не менялось с прошлого запуска - берём ответы из хранилища
+                stored_msg = known.get(msg['ts']) if known else None
+                if (stored_msg and stored_msg.replies is not None
+                        and stored_msg.latest_reply == msg.get('latest_reply')):
+                    metrics.cache_hit('threads')
+                    msg['thread_replies'] = read_stored_json(channel_id, stored_msg.offset)['thread_replies']
+                elif (stored_msg and stored_msg.thread_file is not None and exists(stored_msg.thread_file)
+                        and stored_msg.latest_reply == msg.get('latest_reply')):
+                    metrics.cache_hit('threads')
+                    msg['thread_file'] = stored_msg.thread_file
+                elif fetch_threads:
+                    metrics.cache_hit('threads', False)
+                    threads.append(msg)
+
+        # Найдём понятное имя юзера и упомянутых в тексте
+        if 'user' in msg:
+            msg['user_realname'] = resolve_user(msg['user'])
+        if msg.get('text'):
+            resolve_mentions(msg['text'])
+    return threads
+
+
+def get_messages(ses, method, params, client_msg_id=None, do_print=True, on_page=None, known=None):
+    '''Основная процедура, получаем json сообщений, обрабатываем их.
+    on_page(messages, next_cursor) вызывается после обработки каждой страницы (тогда сообщения не копятся
+    в памяти и не возвращаются), known - уже сохранённые сообщения (ts -> Message), чтобы не перекачивать
+    неизменившиеся обсуждения.
+
+    Обсуждения скачиваются параллельно в общем пуле worker_pool, пока листаем историю дальше.
+    Страница передаётся в on_page только когда скачаны все её обсуждения, и страницы идут по порядку.
+    Если обсуждений ждут PIPELINE_PAGES страниц, следующая не запрашивается, пока не готова самая старая'''
+    cursor = ''
+    messages = []
+    current_day = 0
+    msgs_count = 0
+    global users
 
-            # Сохраняем файлы в отдельный список
-            if 'files' in msg:
-                files.extend(msg['files'])
+    # Ответы в обсуждениях сами обсуждений не содержат, поэтому пул нужен только для истории канала.
+    # Если get_messages вызвали не из export_channels, общего пула нет - заводим свой
+    replies_pool = None
+    own_pool = False
+    if method == 'conversations.history':
+        replies_pool = worker_pool
+        if replies_pool is None:
+            replies_pool = ThreadPool(WORKER_THREADS)
+            own_pool = True
+    # (сообщения страницы, курсор, [(сообщение, ключ - 'thread_replies' или 'thread_file', AsyncResult)])
+    pending_pages = deque()
+
+    def flush_pages(limit=0):
+        '''Отдаём в on_page страницы, у которых скачаны все обсуждения. Пока страниц больше limit,
+        ждём обсуждения самой старой'''
+        while pending_pages:
+            page_messages, page_cursor, page_threads = pending_pages[0]
+            if len(pending_pages) <= limit and not all(res.ready() for _, _, res in page_threads):
+                break
+            for msg, key, res in page_threads:
+                msg[key] = res.get()
+            pending_pages.popleft()
+            if on_page:
+                on_page(page_messages, page_cursor)
 
-        messages.extend(j['messages'])
+    try:
+        while True:
+            if cursor:
+                params.update(cursor=cursor)
+
+            j = http_get(ses, method, params)
+            page_threads = []
+
+            # Запомним за какой день обрабатываем сообщения
+            if len(j['messages']) > 0:
+                msgs_count += len(j['messages'])
+                current_day = day_key(j['messages'][0]['ts'])
+
+            threads = prepare_page(j['messages'], params['channel'], client_msg_id, known,
+                                   fetch_threads=replies_pool is not None)
+            for msg in threads:
+                # Большие обсуждения сразу пишутся в свой файл, остальные - в строку сообщения
+                key, fetch = ('thread_file', save_thread) if is_large_thread(msg) else ('thread_replies', get_replies)
+                res = replies_pool.apply_async(
+                    fetch, (ses, params['channel'], msg['thread_ts'], msg.get('client_msg_id')))
+                page_threads.append((msg, key, res))
 
-        # Берём курсор для следующих сообщений
-        if 'response_metadata' not in j:
-            break
-        if 'next_cursor' in j['response_metadata']:
-            cursor = j['response_metadata']['next_cursor']
-        if 'has_more' in j:
-            if not j['has_more']:
+            if do_print:
+                for msg in j['messages']:
+                    msg_day = day_key(msg['ts'])
+                    if current_day != msg_day:
+                        print(f"{params['channel']}: скачали сообщения c {day_label(msg_day)[2]} "
+                              f"по {day_label(current_day)[2]}...")
+                        current_day = msg_day
+
+            if not on_page:
+                messages.extend(j['messages'])
+
+            # Берём курсор для следующих сообщений
+            next_cursor = ''
+            if 'response_metadata' in j and j.get('has_more'):
+                next_cursor = j['response_metadata'].get('next_cursor', '')
+
+            # Страница обработана - отдаём её в on_page (например, чтобы записать в хранилище),
+            # как только будут готовы её обсуждения
+            pending_pages.append((j['messages'], next_cursor, page_threads))
+            flush_pages(PIPELINE_PAGES - 1)
+
+            if not next_cursor:
                 break
-        else:
-            break
+            cursor = next_cursor
+
+        flush_pages()
+    finally:
+        # Все задачи к этому моменту завершены, а при ошибке ждать оставшиеся обсуждения незачем
+        if own_pool:
+            replies_pool.terminate()
 
     # Сортируем по времени
     messages.sort(key=lambda msg: msg['ts'])
     if do_print:
-        print(f'Скачали {msgs_count} сообщений')
+        print(f"{params['channel']}: скачали {msgs_count} сообщений")
 
     return messages
 
 
-def download_file(ses, total_count, file_entry):
-    global downloaded_file_count
+def resume_request(part_filename, expected_size):
+    '''С какого байта докачивать part_filename (прерванная загрузка) и заголовки запроса с Range.
+    None - он уже скачан целиком'''
+    offset = getsize(part_filename) if exists(part_filename) else 0
+    if expected_size is not None and offset > expected_size:
+        remove(part_filename)
+        offset = 0
+    if expected_size is not None and offset == expected_size:
+        return None
+    return offset, ({'Range': f'bytes={offset}-'} if offset else {})
 
-    downloaded_file_count += 1
-    # Если файл удалён
-    if 'url_private' not in file_entry:
-        # downloaded_file_count += 1
-        print(f"({downloaded_file_count} / {total_count}) - {file_entry['id']} отсутствует.")
-        return False
 
-    fullfilename = ''
-    try:
-        url = file_entry['url_private']
-        filename = file_entry['id'] + splitext(file_entry['url_private'])[1]
-        fullfilename = join(files_folder, filename)
-    except KeyError as e:
-        print(f'у файла нет свойства {e}:')
-        print(file_entry)
-        return False
+def part_mode(offset, status_code):
+    '''Как открыть .part по ответу на запрос с Range: дописать или, если сервер не умеет Range, писать заново'''
+    if offset and status_code == 206:
+        return 'ab'
+    if status_code == 200:
+        return 'wb'
+    raise OtherException(f'HTTP {status_code}')
 
-    if exists(fullfilename):
-        print(f"({downloaded_file_count} / {total_count}) {filename} уже есть в папке")
-        # downloaded_file_count += 1
-        return True
 
-    try:
-        # Качаем файл
-        g = ses.get(url)
+def part_complete(part_filename, expected_size):
+    return expected_size is None or getsize(part_filename) == expected_size
 
-        with open(fullfilename, 'wb') as f:
-            f.write(g.content)
-            # downloaded_file_count += 1
-            print(f'({downloaded_file_count} / {total_count}) {filename} downloaded.')
-        return True
 
-    except Exception as e:
-        print(f'Error: {str(e)} ... Filename: {filename}')
-        print('Спим минуту...')
-        sleep(60)
-        return download_file(ses, total_count, file_entry)
+def stream_to_file(ses, url, part_filename, expected_size):
+    '''Качаем url кусками по CHUNK_SIZE в part_filename. Если он уже есть (прерванная загрузка) -
+    докачиваем через Range. Возвращает True, если размер итогового файла совпал с expected_size'''
+    request = resume_request(part_filename, expected_size)
+    if request is None:
+        return True
+    offset, headers = request
+    with ses.get(url, headers=headers, stream=True, timeout=FILE_TIMEOUT) as r:
+        with open(part_filename, part_mode(offset, r.status_code)) as f:
+            for chunk in r.iter_content(CHUNK_SIZE):
+                f.write(chunk)
+                metrics.add_bytes('files', len(chunk))
+    return part_complete(part_filename, expected_size)
+
+
+def file_target(channel, file_entry):
+    '''Номер файла по порядку, имя и путь для скачивания. None - качать не нужно (удалён или уже скачан)'''
+    with channel.lock:
+        channel.downloaded_file_count += 1
+        file_number = channel.downloaded_file_count
+        total_count = channel.files_total
+    # Если файл удалён
+    if file_entry.url is None:
+        print(f"({file_number} / {total_count}) - {file_entry.id} отсутствует.")
+        return None
+
+    filename = file_entry.id + splitext(file_entry.url)[1]
+    fullfilename = join(channel.files_folder, filename)
+
+    # Файл уже есть в хранилище (скачан в этот или другой канал) - только ссылка на него в папке канала
+    blob = blob_store.find(file_entry)
+    if blob is None and exists(fullfilename):
+        blob = blob_store.adopt(file_entry, fullfilename)
+    if blob is not None:
+        blob_store.link(file_entry, blob, fullfilename)
+        metrics.cache_hit('files')
+        print(f"({file_number} / {total_count}) {filename} уже есть в папке")
+        return None
+    metrics.cache_hit('files', False)
+    return file_number, total_count, filename, fullfilename
+
+
+def store_download(file_entry, target, complete):
+    '''Скачанный .part переносим в хранилище файлов и ссылаемся на него из папки канала.
+    Если размер не совпал (complete=False) - удаляем .part, чтобы следующая попытка качала заново.
+    Возвращает True, если файл сохранён'''
+    file_number, total_count, filename, fullfilename = target
+    part_filename = fullfilename + '.part'
+    if not complete:
+        print(f'Размер {filename} не совпадает с {file_entry.size}, скачиваем заново')
+        remove(part_filename)
+        return False
+    blob_store.link(file_entry, blob_store.add(file_entry, part_filename), fullfilename)
+    print(f'({file_number} / {total_count}) {filename} downloaded.')
+    return True
+
+
+def file_retry_delay(attempt, target, error=None):
+    '''Пауза перед следующей попыткой скачать файл target после неудачной попытки attempt.
+    None - попытки кончились. Повторы файлов не считаются повторами запросов к API в limiter'''
+    if error is not None:
+        print(f'Error: {error!r} ... Filename: {target[2]}')
+    if attempt + 1 >= FILE_RETRIES:
+        return None
+    delay = backoff_seconds(attempt)
+    print(f'Повтор через {delay:.1f} секунд...')
+    return delay
+
+
+def download_failed(target):
+    file_number, total_count, filename, _ = target
+    print(f'({file_number} / {total_count}) Не удалось скачать {filename} за {FILE_RETRIES} попыток')
+    return False
+
+
+def download_file(ses, channel, file_entry):
+    target = file_target(channel, file_entry)
+    if target is None:
+        return file_entry.url is not None
+
+    # Качаем во временный .part и переименовываем только целиком скачанный файл
+    part_filename = target[3] + '.part'
+    for attempt in range(FILE_RETRIES):
+        error = None
+        try:
+            complete = stream_to_file(ses, file_entry.url, part_filename, file_entry.size)
+            if store_download(file_entry, target, complete):
+                return True
+        except Exception as e:
+            error = e
+        delay = file_retry_delay(attempt, target, error)
+        if delay is None:
+            break
+        sleep(delay)
+    return download_failed(target)
 
 
 def delete_windows_symbols(in_str):
@@ -241,124 +1556,614 @@ def delete_windows_symbols(in_str):
     return in_str
 
 
-def html_one_message(msg, idx, is_reply=False):
-    global users
-    global files
+def format_link(link):
+    '''Содержимое <...> из текста Slack: упоминание юзера, канал, спецупоминание или ссылка'''
+    target, _, label = link.partition('|')
+    if not target:
+        return label  # <|текст> - ссылки нет, только подпись
+    if target[0] == '@':
+        return '@' + users.get(target[1:], target[1:])
+    if target[0] == '#':
+        return '#' + (label or target[1:])
+    if target[0] == '!':
+        # <!here>, <!channel>, <!subteam^ID|@team>, <!date^...|текст>
+        return label or '@' + target[1:]
+    return f'<a href="{target}">{label or target}</a>'
+
+
+def format_token(m):
+    kind = m.lastgroup
+    if kind == 'link':
+        return format_link(m.group('link'))
+    if kind == 'newline':
+        return '<br>'
+    if kind == 'spaces':
+        return '&nbsp;' * len(m.group('spaces').replace('\t', '  '))
+    if kind == 'emph':
+        tag = MRKDWN_TAGS[m.group('mark')]
+        return f'<{tag}>{MRKDWN_RE.sub(format_token, m.group("emph"))}</{tag}>'
+    if kind == 'code':
+        return f'<code>{MRKDWN_CODE_RE.sub(format_token, m.group("code"))}</code>'
+    return f'<pre>{MRKDWN_CODE_RE.sub(format_token, m.group("pre"))}</pre>'
+
+
+def format_text(text):
+    '''Текст сообщения в разметке Slack -> html. Исходный текст не меняется'''
+    return MRKDWN_RE.sub(format_token, text)
+
+
+def iter_message_html(channel, msg, idx, is_reply=False):
+    '''Html сообщения (вместе с обсуждением) по кусочкам, чтобы писать их сразу в файл,
+    а не собирать всю страницу в одну огромную строку'''
     msgclass = 'threaded' if is_reply else 'default'
-    html = f'<div class="message {msgclass} clearfix" id="message{idx}">\n' if not is_reply else f'<div class="message {msgclass} clearfix">\n'
+    yield f'<div class="message {msgclass} clearfix" id="message{idx}">\n' if not is_reply else f'<div class="message {msgclass} clearfix">\n'
+    yield from iter_message_body(channel, msg)
 
-    html += (f'<div class="pull_left userpic_wrap">'
+
+def iter_message_body(channel, msg):
+    '''Html сообщения после открывающего тега - не зависит от номера сообщения, поэтому его можно
+    отрендерить заранее (см. PagePipeline)'''
+    yield from iter_message_content(channel, msg)
+
+    # Обсуждение
+    if msg.replies is not None:
+        for th_msg in msg.replies:
+            yield from iter_message_html(channel, th_msg, None, True)
+    elif msg.thread_file is not None:
+        yield from iter_large_thread_html(channel, msg)
+
+    yield '</div></div>\n'
+
+
+def iter_message_content(channel, msg):
+    '''Аватарка, автор, время, текст и файлы сообщения'''
+    yield (f'<div class="pull_left userpic_wrap">'
              '<div class="userpic userpic5" style="width: 42px; height: 42px">'
              '<div class="initials" style="line-height: 42px">\n'
     )
 
     # Аватарка
-    if 'user' in msg:
-        html += f'<img src="users/{msg["user"]}" height=42px width=42px>'
+    if msg.user:
+        yield f'<img src="users/{msg.user}" height=42px width=42px>'
 
-    html += (
+    yield (
         f'</div></div></div>\n<div class="body">\n'
-        f'<div class="pull_right date details">{msg["msg_datetime"]}</div>\n'
+        f'<div class="pull_right date details">{format_ts(msg.ts)}</div>\n'
     )
 
-    if 'user_realname' in msg:
-        html += f'<div class="from_name">{msg["user_realname"]}</div>\n'
-
-
-    # Обрабатываем ссылки
-    if 'text' in msg and (msg['text']):
-        links = re.findall(r'<.*?>', msg['text'])
-        if links:
-            for link in links:
-                # Обрабатываем упоминание юзера
-                if link[1] == "@":
-                    user_id = link[2:-1]
-                    if user_id not in users:
-                        get_user_from_slack(user_id)
-                    msg['text'] = msg['text'].replace(link, '@' + users[user_id])
-                    continue
-                i_pipe = link.find("|")
-                if i_pipe != -1:
-                    link_url = link[1 : i_pipe]
-                    link_text = link[i_pipe+1 : -1]
-                    msg['text'] = msg['text'].replace(link, f'<a href="{link_url}">{link_text}</a>')
-                else:
-                    msg['text'] = msg['text'].replace(link, f'<a href="{link[1:-1]}">{link[1:-1]}</a>')
-        
-        # Обрабатываем: переводы строк -> <br>, символы табуляции -> на 2 пробела
-        msg['text'] = msg['text'].replace('\n', '<br>')
-        msg['text'] = msg['text'].replace('\t', '  ')
-
-        # Форматирование (жирный / курсив / зачеркнутый / код / блок кода)
-        # На версиях python < 3.7 словарь не сохраняет порядок, поэтому сделал порядок по списку
-        d_replaces = {'```': 'pre', '`': 'code', '*': 'b', '_': 'i', '~': 's'}
-        for k in ['```', '`', '*', '_', '~']:
-            v = d_replaces[k]
-            if k in msg['text']:
-                msg['text'] = re.sub(rf'(^|\s*|<br>)\{k}(.+?)\{k}(\s|$|<br>)', rf'\1<{v}>\2</{v}>\3', msg['text'])
-
-        # Пробелы, чтобы оставались как в сообщении
-        for i_space in range(8, 1, -1):
-            msg['text'] = msg['text'].replace(r' ' * i_space, '&nbsp;' * i_space)
-
-        html += f'<div class="text">{msg["text"]}</div>\n'
+    if msg.user_name is not None:
+        yield f'<div class="from_name">{msg.user_name}</div>\n'
+
+
+    if msg.text:
+        yield f'<div class="text">{format_text(msg.text)}</div>\n'
 
     # Файлы в сообщении
-    if 'files' in msg:
-        html += '<div class="clearfix media_wrap">'
+    if msg.files is not None:
+        yield '<div class="clearfix media_wrap">'
 
-        br = '<br>' if len(msg['files']) > 1 else ''
+        br = '<br>' if len(msg.files) > 1 else ''
 
-        for file in msg['files']:
-            if 'url_private' not in file:
-                html += f'&lt;<i>файл удалён</i>&gt;{br}\n'
+        for file in msg.files:
+            if file.url is None:
+                yield f'&lt;<i>файл удалён</i>&gt;{br}\n'
                 continue
 
             # Добавляем ссылку
-            fileext = splitext(file['url_private'])[1]
-            html += (f'<a href="{channel_name}_files/{file["id"]}{fileext}" target="_blank">'
-                     f'<b>{file["title"]}</b>\n'
+            fileext = splitext(file.url)[1]
+            yield (f'<a href="{channel.files_folder}/{file.id}{fileext}" target="_blank">'
+                     f'<b>{file.title}</b>\n'
             )
 
             # Добавляем картинку, если файл = изображение
-            if file['pretty_type'] in {'PNG', 'JPEG', 'Bitmap', 'GIF'}:
-                html += f'<br><img src="{channel_name}_files/{file["id"]}{fileext}" '
+            if file.pretty_type in {'PNG', 'JPEG', 'Bitmap', 'GIF'}:
+                yield f'<br><img src="{channel.files_folder}/{file.id}{fileext}" loading="lazy" '
                 # Правильно выставляем размеры у тега
-                if ('original_w' in file) and (int(file['original_w']) / int(file['original_h'])) > 6:
-                    html += 'width=100%>\n'
+                if file.original_w is not None and file.original_w / file.original_h > 6:
+                    yield 'width=100%>\n'
                 else:
-                    html += 'height=100">\n'
+                    yield 'height=100">\n'
+
+            yield f'</a>{br}'
+        yield '</div>'
+
+
+def iter_large_thread_html(channel, msg):
+    '''Большое обсуждение по channel.large_threads: ответы по одному из файла хранилища ('inline'),
+    они же в свёрнутом блоке ('collapsed') или ссылка на отдельную страницу ('page', см. create_thread_html)'''
+    summary = f'Обсуждение: {msg.reply_count} ответов'
+    if channel.large_threads == 'page':
+        yield (f'<div class="message service"><div class="body details">'
+               f'<a href="{thread_page(channel, msg)}">{summary} &rarr;</a></div></div>\n')
+        return
+    if channel.large_threads == 'collapsed':
+        yield f'<details><summary>{summary}</summary>\n'
+    for reply in iter_thread_file(msg.thread_file):
+        yield from iter_message_html(channel, reply, None, True)
+    if channel.large_threads == 'collapsed':
+        yield '</details>\n'
+
+
+def thread_page(channel, msg):
+    return f'{channel.name}_thread_{msg.ts.replace(".", "_")}.html'
+
+
+def create_thread_html(channel, msg):
+    '''Отдельная страница большого обсуждения: сообщение и все ответы, которые читаются из файла
+    хранилища и пишутся в html по одному'''
+    with open(thread_page(channel, msg), 'w', encoding='utf-8', buffering=HTML_BUFFER_SIZE) as htmlfile:
+        htmlfile.write(html_header(channel, f'{channel.name} - обсуждение от {format_ts(msg.ts)}'))
+        htmlfile.write(f'<div class="message service"><div class="body details">'
+                       f'<a href="{channel.name}.html">&larr; {channel.name}</a></div></div>\n')
+        htmlfile.write('<div class="message default clearfix">\n')
+        htmlfile.writelines(iter_message_content(channel, msg))
+        for reply in iter_thread_file(msg.thread_file):
+            htmlfile.writelines(iter_message_html(channel, reply, None, True))
+        htmlfile.write('</div></div>\n')
+        htmlfile.write(HTML_FOOTER)
+
+
+def html_one_message(channel, msg, idx, is_reply=False):
+    return ''.join(iter_message_html(channel, msg, idx, is_reply))
+
+
+def html_header(channel, title, page_class='chat_page', list_class='history'):
+    search_link = ''
+    if channel.search_page:
+        search_link = f'<div class="pull_right"><a href="{channel.search_page}">Поиск</a></div>'
+    return f'''<!DOCTYPE html>
+<html><head><meta charset="utf-8"/><title>{title}</title>
+<meta content="width=device-width, initial-scale=1.0" name="viewport"/>
+<link href="{channel.files_folder}/style.css" rel="stylesheet"/></head>
+<body><div class="page_wrap"><div class="page_header">
+<div class="content">{search_link}<div class="text bold">{title}</div></div></div>
+<div class="page_body {page_class}"><div class="{list_class}">
+'''
 
-            html += f'</a>{br}'
-        html += '</div>'
 
-    # Обсуждение
-    if 'thread_replies' in msg:
-        for th_idx, th_msg in enumerate(msg['thread_replies']):
-            html += html_one_message(th_msg, str(idx) + '_' + str(th_idx), True)
+HTML_FOOTER = '</div></div></div></body></html>'
 
-    html += '</div></div>\n'
 
+def create_html(channel, messages, iter_html=iter_message_html):
+    '''Пишем страницу канала по мере рендера сообщений, не держа её целиком в памяти.
+    iter_html - iter_message_html или PagePipeline.iter_html с заранее отрендеренными сообщениями'''
+    with open(f'{channel.name}.html', 'w', encoding='utf-8', buffering=HTML_BUFFER_SIZE) as htmlfile:
+        htmlfile.write(html_header(channel, channel.name))
+        for idx, msg in enumerate(messages):
+            htmlfile.writelines(iter_html(channel, msg, idx))
+        htmlfile.write(HTML_FOOTER)
+
+
+def page_key(msg, idx, page_mode):
+    '''Ключ страницы, на которую попадает сообщение: 'ГГГГ-ММ' или номер страницы'''
+    if page_mode == 'month':
+        return day_label(day_key(msg.ts))[1]
+    return f'{idx // int(page_mode) + 1:04d}'
+
+
+def html_pager(channel, prev_page, next_page):
+    '''Ссылки на соседние страницы и на оглавление'''
+    html = '<div class="message service"><div class="body details">'
+    if prev_page:
+        html += f'<a href="{prev_page}">&larr; Назад</a> | '
+    html += f'<a href="{channel.name}.html">Оглавление</a>'
+    if next_page:
+        html += f' | <a href="{next_page}">Вперёд &rarr;</a>'
+    html += '</div></div>\n'
     return html
 
 
-def create_html(messages):
-    html = f'''<!DOCTYPE html>
-<html><head><meta charset="utf-8"/><title>{channel_name}</title>
-<meta content="width=device-width, initial-scale=1.0" name="viewport"/>
-<link href="{files_folder}/style.css" rel="stylesheet"/></head>
-<body><div class="page_wrap"><div class="page_header">
-<div class="content"><div class="text bold">{channel_name}</div></div></div>
-<div class="page_body chat_page"><div class="history">
-'''
+def create_paged_html(channel, messages, page_mode, iter_html=iter_message_html):
+    '''Разбиваем историю на страницы (по месяцам или по page_mode сообщений) и делаем оглавление
+    {channel.name}.html с навигацией по годам и месяцам. Номера message{idx} сквозные, как в одном файле'''
+    # Первый проход: какие страницы будут и где начинается каждый месяц
+    pages = []  # [ключ страницы, имя файла]
+    months = {}  # 'ГГГГ-ММ' -> [файл страницы, idx первого сообщения, количество сообщений]
     for idx, msg in enumerate(messages):
-        html += html_one_message(msg, idx)
-    html += '</div></div></div></body></html>'
-    with open(f'{channel_name}.html', 'w', encoding='utf-8') as htmlfile:
-        htmlfile.write(html)
+        key = page_key(msg, idx, page_mode)
+        if not pages or pages[-1][0] != key:
+            pages.append([key, f'{channel.name}_{key}.html'])
+        month = key if page_mode == 'month' else day_label(day_key(msg.ts))[1]
+        if month not in months:
+            months[month] = [pages[-1][1], idx, 0]
+        months[month][2] += 1
+
+    # Второй проход: пишем страницы по одной
+    page_files = [page[1] for page in pages]
+    page_i = -1
+    htmlfile = None
+    try:
+        for idx, msg in enumerate(messages):
+            if page_i < 0 or page_key(msg, idx, page_mode) != pages[page_i][0]:
+                if htmlfile:
+                    htmlfile.write(html_pager(channel, page_files[page_i - 1] if page_i > 0 else None,
+                                              page_files[page_i + 1]))
+                    htmlfile.write(HTML_FOOTER)
+                    htmlfile.close()
+                page_i += 1
+                prev_page = page_files[page_i - 1] if page_i > 0 else None
+                next_page = page_files[page_i + 1] if page_i + 1 < len(page_files) else None
+                htmlfile = open(page_files[page_i], 'w', encoding='utf-8', buffering=HTML_BUFFER_SIZE)
+                htmlfile.write(html_header(channel, f'{channel.name} - {pages[page_i][0]}'))
+                htmlfile.write(html_pager(channel, prev_page, next_page))
+            htmlfile.writelines(iter_html(channel, msg, idx))
+        if htmlfile:
+            htmlfile.write(html_pager(channel, page_files[page_i - 1] if page_i > 0 else None, None))
+            htmlfile.write(HTML_FOOTER)
+    finally:
+        if htmlfile:
+            htmlfile.close()
+
+    # Оглавление
+    with open(f'{channel.name}.html', 'w', encoding='utf-8') as htmlfile:
+        htmlfile.write(html_header(channel, channel.name, 'list_page', 'entry_list'))
+        current_year = None
+        for month in sorted(months):
+            page_file, first_idx, count = months[month]
+            year, month_number = month.split('-')
+            if year != current_year:
+                htmlfile.write(f'<div class="page_about details with_divider">{year}</div>\n')
+                current_year = year
+            htmlfile.write(
+                f'<a class="entry block_link clearfix" href="{page_file}#message{first_idx}">'
+                f'<div class="body"><div class="name bold">{MONTH_NAMES[int(month_number) - 1]} {year}</div>'
+                f'<div class="details_entry details">Сообщений: {count}</div></div></a>\n'
+            )
+        htmlfile.write(HTML_FOOTER)
+    print(f'Страниц: {len(pages)}')
+
+
+def plain_link(m):
+    '''<...> из текста Slack -> текст без разметки (для индекса и результатов поиска)'''
+    target, _, label = m.group(1).partition('|')
+    if target[:1] == '@':
+        return '@' + users.get(target[1:], target[1:])
+    return label or target.lstrip('#!')
+
+
+def message_page(channel, msg, idx, page_mode):
+    '''Html-файл, в котором окажется сообщение (как в create_html / create_paged_html)'''
+    if not page_mode:
+        return f'{channel.name}.html'
+    return f'{channel.name}_{page_key(msg, idx, page_mode)}.html'
+
+
+def search_term_shard(term):
+    '''Файл индекса для слова: по первым двум буквам, чтобы поиск по началу слова читал один файл'''
+    return 't_' + ''.join(f'{ord(c):05x}' for c in term[:2])
+
+
+def read_search_shard(filename):
+    '''Данные из js-файла индекса (searchIndex.add("имя", данные);)'''
+    with open(filename, 'r', encoding='utf-8') as f:
+        content = f.read()
+    return json.loads(content[content.index(', ') + 2:content.rindex(');')])
+
+
+def write_search_shard(filename, name, data):
+    '''Индекс пишется в js, а не в json: страницу открывают из файла, а fetch() по file:// не работает'''
+    with open(filename + '.tmp', 'w', encoding='utf-8') as f:
+        f.write(f'searchIndex.add("{name}", {json.dumps(data, ensure_ascii=False, separators=(",", ":"))});\n')
+    replace(filename + '.tmp', filename)
+
+
+def update_search_index(channel, messages, page_mode):
+    '''Поисковый индекс канала в {files_folder}/search: файлы t_*.js (слово -> номера сообщений)
+    и d_*.js (номер -> страница, якорь, дата, автор, начало текста). Индексируются текст, автор и названия файлов.
+
+    Индекс дополняется: в него попадают только сообщения и ответы новее уже проиндексированных,
+    переписываются только затронутые файлы. Заново строится, если поменялся page_mode или в середину
+    истории добавились сообщения (тогда сдвигаются номера message{idx})'''
+    folder = join(channel.files_folder, 'search')
+    state_filename = join(STORE_FOLDER, f'{channel.id}.search.json')
+    state = {}
+    if exists(state_filename) and exists(folder):
+        with open(state_filename, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    indexed_ts = float(state.get('indexed_ts') or 0)
+    indexed_reply_ts = float(state.get('indexed_reply_ts') or 0)
+    old_count = sum(1 for msg in messages if float(msg.ts) <= indexed_ts)
+    if state and (state.get('page_mode') != page_mode or old_count != state.get('indexed_count')):
+        print(f'{channel.name}: поисковый индекс строится заново')
+        state = {}
+        indexed_ts = indexed_reply_ts = 0
+    if not state and exists(folder):
+        rmtree(folder)
+    makedirs(folder, exist_ok=True)
+    docs_count = state.get('docs_count', 0)
+
+    postings = {}  # файл -> {слово: [номера сообщений]}
+    docs = []  # новые сообщения для d_*.js, начиная с номера docs_count
+
+    def add_doc(msg, page, anchor):
+        text = LINK_RE.sub(plain_link, msg.text or '')
+        author = msg.user_name or ''
+        terms = set(SEARCH_TERM_RE.findall(f'{text} {author}'.lower()))
+        for file in msg.files or ():
+            terms.update(SEARCH_TERM_RE.findall(file.title.lower()))
+        doc_id = docs_count + len(docs)
+        for term in terms:
+            postings.setdefault(search_term_shard(term), {}).setdefault(term, []).append(doc_id)
+        docs.append([page, anchor, format_ts(msg.ts), author, text[:SEARCH_SNIPPET]])
+
+    def flush():
+        nonlocal docs_count, postings, docs
+        for shard, terms in postings.items():
+            filename = join(folder, f'{shard}.js')
+            data = read_search_shard(filename) if exists(filename) else {}
+            for term, doc_ids in terms.items():
+                data.setdefault(term, []).extend(doc_ids)
+            write_search_shard(filename, shard, data)
+        i = 0
+        while i < len(docs):
+            block = (docs_count + i) // SEARCH_DOCS_PER_SHARD
+            filename = join(folder, f'd_{block}.js')
+            data = read_search_shard(filename) if exists(filename) else []
+            taken = (block + 1) * SEARCH_DOCS_PER_SHARD - (docs_count + i)
+            data.extend(docs[i:i + taken])
+            write_search_shard(filename, f'd_{block}', data)
+            i += taken
+        docs_count += len(docs)
+        postings = {}
+        docs = []
+
+    new_ts = indexed_ts
+    new_reply_ts = indexed_reply_ts
+    for idx, msg in enumerate(messages):
+        ts = float(msg.ts)
+        page = None
+        if ts > indexed_ts:
+            page = message_page(channel, msg, idx, page_mode)
+            add_doc(msg, page, f'message{idx}')
+            new_ts = max(new_ts, ts)
+        if msg.latest_reply and float(msg.latest_reply) <= indexed_reply_ts:
+            continue  # новых ответов нет - не читаем обсуждение (большие лежат в отдельном файле)
+        for reply in iter_replies(msg):
+            reply_ts = float(reply.ts)
+            if reply_ts > indexed_reply_ts:
+                # У ответов нет своего якоря - ведём к родительскому сообщению
+                add_doc(reply, page or message_page(channel, msg, idx, page_mode), f'message{idx}')
+                new_reply_ts = max(new_reply_ts, reply_ts)
+        if len(docs) >= SEARCH_BATCH:
+            flush()
+    flush()
+
+    state = {
+        'indexed_ts': repr(new_ts),
+        'indexed_reply_ts': repr(new_reply_ts),
+        'indexed_count': sum(1 for msg in messages if float(msg.ts) <= new_ts),
+        'docs_count': docs_count,
+        'page_mode': page_mode,
+    }
+    makedirs(STORE_FOLDER, exist_ok=True)  # при --from-export хранилища может ещё не быть
+    with open(state_filename + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    replace(state_filename + '.tmp', state_filename)
+
+
+def create_search_html(channel):
+    '''Страница поиска: грузит через <script> только файлы индекса для слов запроса и файлы
+    с текстами найденных сообщений. Слово запроса совпадает с началом слова в сообщении'''
+    with open(channel.search_page, 'w', encoding='utf-8') as htmlfile:
+        htmlfile.write(html_header(channel, f'{channel.name} - поиск', 'list_page', 'entry_list'))
+        htmlfile.write(SEARCH_PAGE_BODY.replace('{folder}', f'{channel.files_folder}/search')
+                       .replace('{docs_per_shard}', str(SEARCH_DOCS_PER_SHARD)))
+        htmlfile.write(HTML_FOOTER)
+
+
+SEARCH_PAGE_BODY = """<div class="message service"><div class="body">
+<input id="query" type="search" placeholder="Слова для поиска" autofocus style="width: 100%; font-size: 16px; padding: 6px">
+<div class="details" id="status"></div></div></div>
+<div id="results"></div>
+<script>
+var FOLDER = '{folder}', DOCS_PER_SHARD = {docs_per_shard}, MAX_RESULTS = 100;
+var shards = {}, pending = {};
+var searchIndex = {add: function (name, data) {
+    shards[name] = data;
+    (pending[name] || []).forEach(function (cb) { cb(data); });
+    delete pending[name];
+}};
+function loadShard(name) {
+    return new Promise(function (resolve) {
+        if (name in shards) return resolve(shards[name]);
+        if (name in pending) return pending[name].push(resolve);
+        pending[name] = [resolve];
+        var script = document.createElement('script');
+        script.src = FOLDER + '/' + name + '.js';
+        script.onerror = function () { searchIndex.add(name, null); };
+        document.head.appendChild(script);
+    });
+}
+function termShard(term) {
+    return 't_' + Array.from(term).slice(0, 2).map(function (c) {
+        return c.codePointAt(0).toString(16).padStart(5, '0');
+    }).join('');
+}
+function findTerm(term) {
+    // Номера сообщений со словами, которые начинаются с term
+    return loadShard(termShard(term)).then(function (shard) {
+        var found = new Set();
+        for (var word in shard || {})
+            if (word.startsWith(term)) shard[word].forEach(function (id) { found.add(id); });
+        return found;
+    });
+}
+function showResults(terms, ids) {
+    var results = document.getElementById('results');
+    var blocks = Array.from(new Set(ids.map(function (id) { return Math.floor(id / DOCS_PER_SHARD); })));
+    return Promise.all(blocks.map(function (b) { return loadShard('d_' + b); })).then(function () {
+        results.innerHTML = '';
+        ids.forEach(function (id) {
+            var doc = shards['d_' + Math.floor(id / DOCS_PER_SHARD)][id % DOCS_PER_SHARD];
+            var a = document.createElement('a');
+            a.className = 'entry block_link clearfix';
+            a.href = doc[0] + '#' + doc[1];
+            var body = document.createElement('div');
+            body.className = 'body';
+            var name = document.createElement('div');
+            name.className = 'name bold';
+            name.textContent = doc[3] + '  ' + doc[2];
+            var text = document.createElement('div');
+            text.className = 'details_entry details';
+            text.textContent = doc[4];
+            body.appendChild(name);
+            body.appendChild(text);
+            a.appendChild(body);
+            results.appendChild(a);
+        });
+    });
+}
+var searchNumber = 0;
+function search() {
+    var number = ++searchNumber;
+    var terms = (document.getElementById('query').value.toLowerCase().match(/[\\p{L}\\p{N}_]{2,}/gu) || []);
+    var status = document.getElementById('status');
+    if (!terms.length) {
+        status.textContent = '';
+        document.getElementById('results').innerHTML = '';
+        return;
+    }
+    status.textContent = 'Ищем...';
+    Promise.all(terms.map(findTerm)).then(function (sets) {
+        if (number !== searchNumber) return;
+        sets.sort(function (a, b) { return a.size - b.size; });
+        var ids = Array.from(sets[0]).filter(function (id) {
+            return sets.every(function (set) { return set.has(id); });
+        });
+        ids.sort(function (a, b) { return b - a; });
+        status.textContent = 'Найдено: ' + ids.length + (ids.length > MAX_RESULTS ? ', показаны последние ' + MAX_RESULTS : '');
+        return showResults(terms, ids.slice(0, MAX_RESULTS));
+    });
+}
+var timer = null;
+document.getElementById('query').addEventListener('input', function () {
+    clearTimeout(timer);
+    timer = setTimeout(search, 250);
+});
+</script>
+"""
+
+
+# Машиночитаемая выгрузка --------------------------------------------------------
+# Строка на каждое сообщение и каждый ответ (thread_ts - ts родителя, у родителя с ответами - свой ts).
+# Ключи JSONL - как у Slack, поэтому load_export читает выгрузку обратно в Message для html без сети.
+
+def file_record(file):
+    j = {'id': file.id, 'url_private': file.url, 'title': file.title, 'pretty_type': file.pretty_type,
+         'size': file.size, 'original_w': file.original_w, 'original_h': file.original_h}
+    return {key: value for key, value in j.items() if value is not None}
+
+
+def iter_records(channel, messages):
+    '''Строки выгрузки по времени: сообщение, затем ответы его обсуждения'''
+    for msg in messages:
+        yield message_record(channel, msg, msg.ts if msg.replies or msg.thread_file else None)
+        for reply in iter_replies(msg):
+            yield message_record(channel, reply, msg.ts)
+
+
+def message_record(channel, msg, thread_ts):
+    return {
+        'channel': channel.id,
+        'ts': msg.ts,
+        'thread_ts': thread_ts,
+        'user': msg.user,
+        'user_realname': msg.user_name,
+        'text': msg.text,
+        'files': [file_record(file) for file in msg.files] if msg.files is not None else None,
+    }
 
 
-def create_style_css():
+def write_jsonl_export(filename, records):
+    '''JSONL-выгрузка: строки пишутся по одной через буфер, файл заменяется целиком в конце'''
+    with open(filename + '.tmp', 'w', encoding='utf-8', buffering=HTML_BUFFER_SIZE) as f:
+        for record in records:
+            f.write(json.dumps({key: value for key, value in record.items() if value is not None},
+                               ensure_ascii=False))
+            f.write('\n')
+    replace(filename + '.tmp', filename)
+
+
+def write_parquet_export(filename, records):
+    '''Parquet-выгрузка с типизированными колонками, по EXPORT_BATCH строк в группе'''
+    schema = pa.schema([
+        ('channel', pa.string()),
+        ('ts', pa.string()),
+        ('time', pa.timestamp('us', tz='UTC')),
+        ('thread_ts', pa.string()),
+        ('user', pa.string()),
+        ('user_realname', pa.string()),
+        ('text', pa.string()),
+        ('file_ids', pa.list_(pa.string())),
+    ])
+    with pq.ParquetWriter(filename + '.tmp', schema) as writer:
+        while True:
+            batch = list(islice(records, EXPORT_BATCH))
+            if not batch:
+                break
+            columns = {name: [record.get(name) for record in batch]
+                       for name in ('channel', 'ts', 'thread_ts', 'user', 'user_realname', 'text')}
+            columns['time'] = [ts_micros(record['ts']) for record in batch]
+            columns['file_ids'] = [[file['id'] for file in record['files']] if record['files'] is not None else None
+                                   for record in batch]
+            writer.write_table(pa.Table.from_pydict(columns, schema))
+    replace(filename + '.tmp', filename)
+
+
+def export_records(channel, messages, formats):
+    '''Машиночитаемые выгрузки канала: {channel}.jsonl и/или {channel}.parquet'''
+    if 'jsonl' in formats:
+        write_jsonl_export(f'{channel.name}.jsonl', iter_records(channel, messages))
+        print(f'{channel.name}: выгрузка в {channel.name}.jsonl')
+    if 'parquet' in formats:
+        write_parquet_export(f'{channel.name}.parquet', iter_records(channel, messages))
+        print(f'{channel.name}: выгрузка в {channel.name}.parquet')
+
+
+def load_export(filename):
+    '''Сообщения из JSONL-выгрузки: ответы собираются в обсуждения по thread_ts.
+    Возвращает (id канала, сообщения по времени)'''
+    channel_id = None
+    messages = []
+    by_ts = {}
+    with open(filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            j = json.loads(line)
+            channel_id = j['channel']
+            parent = by_ts.get(j.get('thread_ts', j['ts']))
+            if parent is not None and j['ts'] != parent.ts:
+                if parent.replies is None:
+                    parent.replies = []
+                parent.replies.append(Message(j))
+            else:
+                msg = Message(j)
+                by_ts[msg.ts] = msg
+                messages.append(msg)
+    messages.sort(key=lambda msg: msg.ts)
+    for msg in messages:
+        if msg.replies:
+            msg.replies.sort(key=lambda reply: reply.ts)
+    return channel_id, messages
+
+
+def render_export(filename, page_mode=PAGE_MODE, search=SEARCH_INDEX, formats=EXPORT_FORMATS,
+                  large_threads=LARGE_THREADS):
+    '''Html (и поиск) канала из его JSONL-выгрузки, без запросов к Slack. Имя канала - имя файла.
+    Упоминания юзеров берутся из сохранённого справочника'''
+    load_users_cache()
+    channel_id, messages = load_export(filename)
+    if channel_id is None:
+        print(f'{filename}: выгрузка пуста')
+        return None
+    channel = Channel(channel_id, splitext(basename(filename))[0])
+    render_channel(channel, messages, page_mode, search, formats=[fmt for fmt in formats if fmt != 'jsonl'],
+                   large_threads=large_threads)
+    return channel
+
+
+def create_style_css(channel):
     compressed = (b'x\xda\xa5XIs\xdb6\x14>\xc7\xbf\x02\xb5\xa7\x93\xc4#\xca$E-\x96N\x9d\x1c\xdaC\xd3\x1e:\xedU\x03\x12\xa0\x84\x1a\x02X\x00\x94\xecd\xfc\xdf\xfb\xc0'
         b'\x15\xdc,OK\xc5\x13\tx\xf8\xde\xbe\x80\xb1$/\xe8\xfb\r\x82\xe7\x84\xd5\x81\x89-\xf2w\xc5\xcfT\n\xb3EA\x98=?\x04\x9b\xec\x19}\xfc=\xa3\x02\xfd\x81\x85\xfe8\xbb'
         b'\xfd5O\x18\xc1\xe8g\x85\x05\xa1\xb7\xcdo\xbb\x8b\xfe\x14,\x91v\xf5\'\xc50\x9f\xfdB\xf9\x99\x1a\x96\xe0\xd9_T\x11,\xf0L\x03\x95\xa7\xa9b\xe9\xee\xe6\xf5F\x1b%\xc5'
@@ -392,110 +2197,616 @@ def create_style_css():
         b'\x00S\x0c\xfc\xc5\xa5\xa8\x088\xd7\x1eX\xb0\x13\x86\x1a\xdd\x89\xc4\xc6\xf8\x8ar\x18\xe7\xcet\nn\x0c\xc9]+\xee\x8a\xee\x02\xd8;yj&\xa6\xfet\xfaz\xf3/ \xd0\xa9~'
     )
     decompressed = zlib.decompress(compressed)
-    with open(join(files_folder, 'style.css'), 'w', encoding='utf-8') as style_file:
+    makedirs(channel.files_folder, exist_ok=True)
+    with open(join(channel.files_folder, 'style.css'), 'w', encoding='utf-8') as style_file:
         style_file.write(decompressed.decode('utf-8'))
 
-# ------------------------------------------------------------------------------
+def get_channel(ses, channel_id):
+    '''Канал по id через conversations.info'''
+    j = http_get(ses, 'conversations.info', {'channel': channel_id})
+    return Channel(channel_id, j['channel'].get('name', channel_id))
 
-chdir(dirname(__file__))
-files_folder = ''
 
-downloaded_file_count = 0
+def get_channels(ses, channel_ids, failed):
+    '''Каналы по списку id. Канал, который не нашёлся или недоступен, записывается в failed (id -> ошибка),
+    остальные выгружаются'''
+    channels = []
+    for channel_id in channel_ids:
+        try:
+            channels.append(get_channel(ses, channel_id))
+        except Exception as e:
+            print(f'Ошибка при выгрузке канала {channel_id}: {e}')
+            failed[channel_id] = e
+    return channels
 
-ses_users = req.Session()
-ses = req.Session()
-ses.headers.update({
-    "Content-Type": "application/x-www-form-urlencoded",
-    "Authorization": f"Bearer {TOKEN}"
-})
-t1 = time()
 
-# Получаем имя канала
-while True:
+def list_channels(ses, types=CHANNEL_TYPES):
+    '''Все каналы воркспейса, в которые добавлено приложение (conversations.list)'''
+    channels = []
+    params = {'types': types, 'limit': CHANNELS_PER_REQUEST, 'exclude_archived': 'false'}
+    while True:
+        j = http_get(ses, 'conversations.list', params)
+        for j_channel in j['channels']:
+            # История доступна только в каналах, где есть приложение
+            if j_channel.get('is_member', True):
+                channels.append(Channel(j_channel['id'], j_channel.get('name', j_channel['id'])))
+
+        next_cursor = j.get('response_metadata', {}).get('next_cursor', '')
+        if not next_cursor:
+            break
+        params['cursor'] = next_cursor
+    return channels
+
+
+def export_channel(channel, download_files=True, page_mode=PAGE_MODE, search=SEARCH_INDEX, formats=EXPORT_FORMATS,
+                   large_threads=LARGE_THREADS, full_sync=False):
+    '''Выгрузка одного канала: история (с обсуждениями), файлы-прикрепления, html и поисковый индекс.
+    Обсуждения уходят в общий worker_pool, файлы - в files_pool, запросы к API - через общий limiter.
+    Файлы качаются и html рендерится, пока листается история (PagePipeline)'''
+    def submit(file_entry, done):
+        files_pool.apply_async(download_file, (ses, channel, file_entry),
+                                callback=lambda _: done(), error_callback=lambda _: done())
+
+    # Скачиваем историю чата (только то, чего ещё нет в локальном хранилище)
+    sync, pipeline = start_channel_export(channel, submit if download_files else None, large_threads, full_sync)
     try:
-        CHANNEL = input('Скопируйте и введите ID нужного канала (вида C01EQ5V9665), но '
-                        'сначала проверьте, добавлено ли приложение в этот канал\nID: ').strip()
-        # junior chat = C02HT9EALVB
-        # support chat = C02EQ5V9665
+        with metrics.stage('history'):
+            try:
+                get_messages(ses, 'conversations.history', sync.params, on_page=pipeline.put, known=sync.stored)
+            finally:
+                pipeline.close()
+            messages = sync.finish()
+        finish_channel_export(channel, pipeline, messages, page_mode, search, formats, large_threads)
+    finally:
+        pipeline.discard()
+    return channel
+
+
+def start_channel_export(channel, submit, large_threads, full_sync):
+    '''Синхронизация канала с хранилищем и конвейер для её страниц (общее для обоих движков)'''
+    print(f'Скачиваем канал {channel.name} ({channel.id})')
+    channel.large_threads = large_threads
+    sync = ChannelSync(channel.id, full_sync)
+    return sync, PagePipeline(sync, channel, submit)
+
+
+def finish_channel_export(channel, pipeline, messages, page_mode, search, formats, large_threads):
+    '''После истории: оставшиеся файлы, хранилище файлов, html, поиск и выгрузки (общее для обоих движков)'''
+    # Файлы новых сообщений уже качаются, остальные проверяем по хранилищу файлов
+    with metrics.stage('files'):
+        pipeline.finish(messages)
+    if channel.files_total:
+        blob_store.save()
+        print(f'Файлы-прикрепления ({channel.files_total}) сохранены в папку {channel.files_folder}')
+
+    render_channel(channel, messages, page_mode, search, pipeline.iter_html, formats, large_threads)
+
+
+def render_channel(channel, messages, page_mode=PAGE_MODE, search=SEARCH_INDEX, iter_html=iter_message_html,
+                   formats=EXPORT_FORMATS, large_threads=LARGE_THREADS):
+    '''Html, стили, поисковый индекс и машиночитаемые выгрузки (formats) канала'''
+    with metrics.stage('render'):
+        channel.large_threads = large_threads
+        if search:
+            channel.search_page = f'{channel.name}_search.html'
+        if large_threads == 'page':
+            for msg in messages:
+                if msg.thread_file is not None:
+                    create_thread_html(channel, msg)
+        if page_mode:
+            create_paged_html(channel, messages, page_mode, iter_html)
+        else:
+            create_html(channel, messages, iter_html)
+        create_style_css(channel)
+    if search:
+        with metrics.stage('search'):
+            update_search_index(channel, messages, page_mode)
+            create_search_html(channel)
+        print(f'{channel.name}: поиск по истории - {channel.search_page}')
+    if formats:
+        with metrics.stage('export'):
+            export_records(channel, messages, formats)
+    print(f'История чата сохранена в файл {channel.name}.html')
+
+
+def export_channels(channel_ids=None, token=None, parallel=CHANNELS_PARALLEL, workers=WORKER_THREADS,
+                    page_mode=PAGE_MODE, download_files=True, types=CHANNEL_TYPES, search=SEARCH_INDEX,
+                    engine=ENGINE, formats=EXPORT_FORMATS, large_threads=LARGE_THREADS, full_sync=False):
+    '''Выгрузка нескольких каналов (или всех, если channel_ids не задан) за один запуск.
+
+    Каналы выгружаются по parallel штук одновременно. Обсуждения, файлы и фото юзеров всех каналов
+    идут в один пул из workers потоков, запросы к API - через один limiter и одну сессию ses,
+    справочник пользователей загружается один раз. engine='async' - то же на asyncio
+    (см. export_channels_async). full_sync - перечитать историю целиком (см. ChannelSync). Возвращает (выгруженные каналы, {id: ошибка})'''
+    global blob_store
+
+    if token:
+        ses.headers.update({"Authorization": f"Bearer {token}"})
+    # Пул соединений requests по умолчанию на 10 соединений - меньше, чем потоков при большом workers
+    adapter = req.adapters.HTTPAdapter(pool_connections=parallel + 1, pool_maxsize=2 * workers + parallel)
+    ses.mount('https://', adapter)
+    ses.mount('http://', adapter)
+
+    if 'parquet' in formats and pa is None:
+        print('Для выгрузки в Parquet нужен pyarrow (pip install pyarrow) - пропускаем её')
+        formats = [fmt for fmt in formats if fmt != 'parquet']
+    if engine == 'async' and aiohttp is None and httpx is None:
+        print('Для асинхронного движка нужен aiohttp или httpx (pip install aiohttp) - используем синхронный')
+        engine = 'sync'
+
+    t1 = time()
+    blob_store = BlobStore()
+    if engine == 'async':
+        channels, failed = asyncio.run(export_channels_async(
+            channel_ids, parallel, workers, page_mode, download_files, types, search, formats, large_threads,
+            full_sync))
+    else:
+        channels, failed = export_channels_sync(
+            channel_ids, parallel, workers, page_mode, download_files, types, search, formats, large_threads,
+            full_sync)
+
+    print('Завершено за {:.2f} секунд'.format(time() - t1))
+    print(limiter.summary())
+    return [channel for channel in channels if channel.id not in failed], failed
+
+
+def export_channels_sync(channel_ids, parallel, workers, page_mode, download_files, types, search, formats,
+                         large_threads, full_sync):
+    '''Синхронный движок: requests, общий пул потоков worker_pool и пул files_pool для файлов'''
+    global worker_pool, files_pool, avatars
+
+    worker_pool = ThreadPool(workers)
+    files_pool = ThreadPool(workers)
+    failed = {}
+    try:
+        # Справочник пользователей - до истории, чтобы не спрашивать каждого юзера отдельно
+        with metrics.stage('users'):
+            prefetch_users(ses)
+        avatars = AvatarDownloader(ses_users, worker_pool)
+
+        if channel_ids is None:
+            channels = list_channels(ses, types)
+            print(f'Найдено каналов: {len(channels)}')
+        else:
+            channels = get_channels(ses, channel_ids, failed)
 
-        j = http_get(ses, 'conversations.info', {'channel': CHANNEL})
-        break
-    except ChannelNotFoundException as e:
-        print(f'Error: Канал с ID {CHANNEL} не найден')
-    except OtherException as e:
-        print(e)
+        def export_one(channel):
+            try:
+                export_channel(channel, download_files, page_mode, search, formats, large_threads, full_sync)
+            except Exception as e:
+                print(f'Ошибка при выгрузке канала {channel.name} ({channel.id}): {e}')
+                failed[channel.id] = e
+
+        channels_pool = ThreadPool(parallel)
+        try:
+            channels_pool.map(export_one, channels)
+        finally:
+            channels_pool.terminate()
+
+        save_users_cache()
+        with metrics.stage('avatars'):
+            avatars.join()
+    finally:
+        worker_pool.terminate()
+        files_pool.terminate()
+        worker_pool = files_pool = None
+    return channels, failed
+
+
+# Асинхронный движок ------------------------------------------------------------
+# История, обсуждения, файлы и фото всех каналов - задачи одного цикла событий с общим пулом
+# keep-alive соединений: aiohttp или httpx.AsyncClient (с h2 - HTTP/2 к файловым хостам).
+# Справочник юзеров, поиск каналов и запись хранилища/html - те же функции, что у синхронного
+# движка, в потоках через asyncio.to_thread, чтобы не останавливать цикл событий.
+
+class AiohttpResponse:
+    '''Прочитанный ответ aiohttp с теми же полями, что у ответа httpx'''
+    __slots__ = ('status_code', 'headers', 'content')
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class AiohttpStream:
+    '''Потоковый ответ aiohttp с интерфейсом httpx (status_code, aiter_bytes)'''
+
+    def __init__(self, response):
+        self.response = response
+        self.status_code = response.status
+        self.headers = response.headers
+
+    def aiter_bytes(self, chunk_size):
+        return self.response.content.iter_chunked(chunk_size)
+
+
+class AiohttpClient:
+    '''aiohttp.ClientSession с той частью интерфейса httpx.AsyncClient, которой пользуется движок'''
+
+    def __init__(self, headers=None, connections=100):
+        connector = aiohttp.TCPConnector(limit=connections, keepalive_timeout=ASYNC_KEEPALIVE)
+        self.session = aiohttp.ClientSession(headers=headers, connector=connector,
+                                             timeout=aiohttp.ClientTimeout(sock_connect=FILE_TIMEOUT,
+                                                                           sock_read=FILE_TIMEOUT))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    async def get(self, url, params=None, headers=None):
+        async with self.session.get(url, params=params, headers=headers) as r:
+            return AiohttpResponse(r.status, r.headers, await r.read())
+
+    @asynccontextmanager
+    async def stream(self, method, url, headers=None):
+        async with self.session.request(method, url, headers=headers) as r:
+            yield AiohttpStream(r)
+
+
+def async_client(headers, connections):
+    '''Клиент асинхронного движка: aiohttp или httpx (см. ASYNC_BACKEND)'''
+    backend = ASYNC_BACKEND or ('aiohttp' if aiohttp is not None else 'httpx')
+    if backend == 'aiohttp':
+        return AiohttpClient(headers, connections)
+    limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections,
+                          keepalive_expiry=ASYNC_KEEPALIVE)
+    # Как requests и aiohttp, идём по редиректам (стандартные фото юзеров отдаются через 302)
+    return httpx.AsyncClient(headers=headers, limits=limits, timeout=httpx.Timeout(FILE_TIMEOUT),
+                             http2=h2 is not None, follow_redirects=True)
+
+async def http_get_async(client, method, params):
+    '''http_get на асинхронном клиенте: те же лимиты, повторы и метрики (api_retry_delay)'''
+    attempt = 0
+    while True:
+        waited = await limiter.acquire_async(method)
+        if waited:
+            metrics.add_rate_limited(method, waited)
+        started = perf_counter()
+        r = error = None
+        try:
+            r = await client.get(f'{HOST}/{method}', params=params)
+        except Exception as e:
+            error = e
+        delay = api_retry_delay(method, attempt, perf_counter() - started, r, error)
+        if delay is None:
+            return slack_json(r)
+        if delay:
+            attempt += 1
+            await asyncio.sleep(delay)
 
-try:
-    channel_name = delete_windows_symbols(j['channel']['name'])
-    print(f'Скачиваем канал {channel_name}')
-    files_folder = f'{channel_name}_files'
 
-    # Скачиваем историю чата
+async def iter_reply_pages_async(client, channel_id, thread_ts, client_msg_id):
+    '''iter_reply_pages на асинхронном клиенте'''
     params = {
-        'channel': CHANNEL,
-        'limit': MESSAGES_PER_REQUEST
+        'channel': channel_id,
+        'limit': MESSAGES_PER_REQUEST,
+        'ts': thread_ts
     }
-    messages = get_messages(ses, 'conversations.history', params)
-    t2 = time()
-    print('Завершено за {:.2f} секунд'.format(t2-t1))
-
-    ### DEBUG
-    # Сохранение json с сообщениями
-    # with open(f'{channel_name}.json', 'w', encoding='utf-8') as f:
-    #     json.dump(messages, f, indent=4, ensure_ascii=False)
-
-    ### DEBUG
-    # Подгружаем файлы из уже скачанного файла сообщений
-    # with open(f'{channel_name}.json', 'r', encoding='utf-8') as fil:
-    #     j = json.load(fil)
-    # msg_count = 0
-    # files_count = 0
-    # makedirs(files_folder, exist_ok=True)
-    # for msg in j:
-    #     if 'files' in msg:
-    #         msg_count += 1
-    #         files_count += len(msg['files'])
-    #         files.extend(msg['files'])  
-    #         if 'thread_replies' in msg:
-    #             for replmsg in msg['thread_replies']:
-    #                 if 'files' in replmsg:
-    #                     files.extend(replmsg['files'])
-    #                     files_count += 1
-    # print(msg_count, files_count, len(files)) 
-    # --------------------------------------------------------------------------
-
-    # Скачивание файлов-прикреплений из сообщений
-    print()
     while True:
-        # do_download_files = input('Скачать файлы-прикрепления из сообщений? (y/n) (д/н): > ')
-        do_download_files = 'y'
-        if len(do_download_files.strip()) == 1:
-            if do_download_files in 'yYдДnNнН':
+        j = await http_get_async(client, 'conversations.replies', params)
+        await asyncio.to_thread(prepare_page, j['messages'], channel_id, client_msg_id, fetch_threads=False)
+        yield [msg for msg in j['messages'] if msg['ts'] != thread_ts]
+        next_cursor = next_page_cursor(j)
+        if not next_cursor:
+            break
+        params['cursor'] = next_cursor
+
+
+async def get_replies_async(client, channel_id, thread_ts, client_msg_id):
+    '''Ответы обсуждения без родительского сообщения (как get_replies)'''
+    replies = []
+    async with async_slots:
+        with metrics.stage('replies'):
+            async for page in iter_reply_pages_async(client, channel_id, thread_ts, client_msg_id):
+                replies.extend(page)
+    replies.sort(key=lambda msg: msg['ts'])
+    return replies
+
+
+async def save_thread_async(client, channel_id, thread_ts, client_msg_id):
+    '''save_thread на асинхронном клиенте'''
+    async with async_slots:
+        with metrics.stage('replies'), thread_writer(channel_id, thread_ts) as f:
+            async for page in iter_reply_pages_async(client, channel_id, thread_ts, client_msg_id):
+                await asyncio.to_thread(write_replies, f, page)
+    return thread_path(channel_id, thread_ts)
+
+
+async def sync_channel_async(client, sync, on_page):
+    '''Листание истории для ChannelSync на асинхронном движке. Страницы идут по очереди (следующую даёт курсор),
+    обсуждения каждой страницы качаются задачами, пока листаем дальше. Страницы отдаются в on_page
+    (в потоке) по порядку, когда готовы все их обсуждения. Как и в get_messages, обсуждений ждут
+    не больше PIPELINE_PAGES страниц'''
+    channel_id = sync.channel_id
+    params = sync.params
+    pending_pages = deque()  # (сообщения страницы, курсор, [(сообщение, ключ, задача с ответами)])
+    msgs_count = 0
+
+    async def flush_pages(limit=0):
+        while pending_pages:
+            page_messages, page_cursor, page_threads = pending_pages[0]
+            if len(pending_pages) <= limit and not all(task.done() for _, _, task in page_threads):
                 break
-        print('Непонятный ответ :)')
-
-    if do_download_files in 'yYдД':
-        print('Скачиваем файлы...')
-        makedirs(files_folder, exist_ok=True)
-        threads = 4
-        pool = ThreadPool(threads)
-        pool.map(partial(download_file, ses, len(files)), files)
-        pool.close()
-        pool.join()
-        print(f'Файлы-прикрепления сохранены в папку {files_folder}')
-    # print(f'История чата сохранена в файл {channel_name}.json')
-
-    create_html(messages)
-    create_style_css()
-
-    print(f'История чата сохранена в файл {channel_name}.html')
-    if exists(f'{channel_name}.html'):
-        Popen(('start', f'{channel_name}.html'), shell=True)
-    print('Завершено')
-
-except Exception as e:
-    raise e
-    # print(e)
-finally:
-    ses.close()
-    ses_users.close()
+            for msg, key, task in page_threads:
+                msg[key] = await task
+            pending_pages.popleft()
+            await asyncio.to_thread(on_page, page_messages, page_cursor)
+
+    try:
+        while True:
+            j = await http_get_async(client, 'conversations.history', params)
+            threads = await asyncio.to_thread(prepare_page, j['messages'], channel_id, None, sync.stored)
+            page_threads = []
+            for msg in threads:
+                key, fetch = (('thread_file', save_thread_async) if is_large_thread(msg)
+                              else ('thread_replies', get_replies_async))
+                task = asyncio.ensure_future(fetch(client, channel_id, msg['thread_ts'], msg.get('client_msg_id')))
+                page_threads.append((msg, key, task))
+            if j['messages']:
+                msgs_count += len(j['messages'])
+                print(f"{channel_id}: скачали сообщения c {day_label(day_key(j['messages'][-1]['ts']))[2]} "
+                      f"по {day_label(day_key(j['messages'][0]['ts']))[2]}...")
+
+            next_cursor = next_page_cursor(j)
+            pending_pages.append((j['messages'], next_cursor, page_threads))
+            await flush_pages(PIPELINE_PAGES - 1)
+            if not next_cursor:
+                break
+            params['cursor'] = next_cursor
+        await flush_pages()
+    finally:
+        # При ошибке недокачанные обсуждения не нужны
+        for _, _, page_threads in pending_pages:
+            for _, _, task in page_threads:
+                task.cancel()
+
+    print(f'{channel_id}: скачали {msgs_count} сообщений')
+
+
+async def stream_to_file_async(client, url, part_filename, expected_size):
+    '''stream_to_file на асинхронном клиенте: докачка через Range, проверка размера'''
+    request = resume_request(part_filename, expected_size)
+    if request is None:
+        return True
+    offset, headers = request
+    async with client.stream('GET', url, headers=headers) as r:
+        with open(part_filename, part_mode(offset, r.status_code)) as f:
+            async for chunk in r.aiter_bytes(CHUNK_SIZE):
+                f.write(chunk)
+                metrics.add_bytes('files', len(chunk))
+    return part_complete(part_filename, expected_size)
+
+
+async def download_file_async(client, channel, file_entry):
+    # Поиск в хранилище может посчитать sha256 старого файла - в потоке, не в цикле событий
+    target = await asyncio.to_thread(file_target, channel, file_entry)
+    if target is None:
+        return file_entry.url is not None
+
+    part_filename = target[3] + '.part'
+    async with file_slots:
+        for attempt in range(FILE_RETRIES):
+            error = None
+            try:
+                complete = await stream_to_file_async(client, file_entry.url, part_filename, file_entry.size)
+                # sha256 для хранилища файлов считаем в потоке
+                if await asyncio.to_thread(store_download, file_entry, target, complete):
+                    return True
+            except Exception as e:
+                error = e
+            delay = file_retry_delay(attempt, target, error)
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+    return download_failed(target)
+
+
+async def export_channel_async(client, channel, download_files=True, page_mode=PAGE_MODE, search=SEARCH_INDEX,
+                               formats=EXPORT_FORMATS, large_threads=LARGE_THREADS, full_sync=False):
+    '''export_channel на асинхронном движке. Файлы - задачи цикла событий, которые поток конвейера
+    запускает через run_coroutine_threadsafe; html и индекс строятся в отдельном потоке'''
+    loop = asyncio.get_running_loop()
+
+    def submit(file_entry, done):
+        future = asyncio.run_coroutine_threadsafe(download_file_async(client, channel, file_entry), loop)
+        future.add_done_callback(lambda _: done())
+
+    sync, pipeline = await asyncio.to_thread(start_channel_export, channel, submit if download_files else None,
+                                             large_threads, full_sync)
+    try:
+        with metrics.stage('history'):
+            try:
+                await sync_channel_async(client, sync, pipeline.put)
+            finally:
+                await asyncio.to_thread(pipeline.close)
+            messages = await asyncio.to_thread(sync.finish)
+        await asyncio.to_thread(finish_channel_export, channel, pipeline, messages, page_mode, search, formats,
+                                large_threads)
+    finally:
+        pipeline.discard()
+    return channel
+
+
+async def export_channels_async(channel_ids, parallel, workers, page_mode, download_files, types, search, formats,
+                                large_threads, full_sync):
+    '''Асинхронный движок: один цикл событий, workers одновременных запросов к API и фото (async_slots)
+    и workers загрузок файлов (file_slots), два клиента - для API и файлов (с токеном) и для фото юзеров'''
+    global avatars, async_slots, file_slots
+
+    async_slots = asyncio.Semaphore(workers)
+    file_slots = asyncio.Semaphore(workers)
+    # Каждый канал может держать поток исполнителя, пока ждёт конвейер (очередь страниц, файлы),
+    # поэтому потоков должно хватать и на них, и на работу, которую делают загрузки файлов
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(parallel + workers))
+    failed = {}
+    auth = {'Authorization': ses.headers['Authorization'].strip()}
+    async with async_client(auth, 2 * workers + parallel) as client, async_client(None, workers) as users_client:
+        with metrics.stage('users'):
+            await asyncio.to_thread(prefetch_users, ses)
+        avatars = AvatarDownloader(ses_users, None)
+
+        if channel_ids is None:
+            channels = await asyncio.to_thread(list_channels, ses, types)
+            print(f'Найдено каналов: {len(channels)}')
+        else:
+            channels = await asyncio.to_thread(get_channels, ses, channel_ids, failed)
+
+        channel_slots = asyncio.Semaphore(parallel)
+
+        async def export_one(channel):
+            async with channel_slots:
+                try:
+                    await export_channel_async(client, channel, download_files, page_mode, search, formats,
+                                               large_threads, full_sync)
+                except Exception as e:
+                    print(f'Ошибка при выгрузке канала {channel.name} ({channel.id}): {e}')
+                    failed[channel.id] = e
+
+        await asyncio.gather(*(export_one(channel) for channel in channels))
+
+        save_users_cache()
+        with metrics.stage('avatars'):
+            await avatars.join_async(users_client)
+    return channels, failed
+
+
+def ask_channel_id():
+    '''Спрашиваем id канала, пока не введут существующий'''
+    while True:
+        channel_id = input('Скопируйте и введите ID нужного канала (вида C01EQ5V9665), но '
+                           'сначала проверьте, добавлено ли приложение в этот канал\nID: ').strip()
+        # junior chat = C02HT9EALVB
+        # support chat = C02EQ5V9665
+        try:
+            http_get(ses, 'conversations.info', {'channel': channel_id})
+            return channel_id
+        except ChannelNotFoundException:
+            print(f'Error: Канал с ID {channel_id} не найден')
+        except OtherException as e:
+            print(e)
+
+
+def parse_page_mode(value):
+    return value if value == 'month' else int(value)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Скачивает историю каналов Slack в html вместе с файлами и фото юзеров. '
+                    'Без аргументов спрашивает id одного канала.')
+    parser.add_argument('channels', nargs='*', help='id каналов (вида C01EQ5V9665)')
+    parser.add_argument('--all', action='store_true', help='выгрузить все каналы, где есть приложение')
+    parser.add_argument('--types', default=CHANNEL_TYPES, help='типы каналов для --all')
+    parser.add_argument('--token', default=environ.get('SLACK_TOKEN', TOKEN),
+                        help='токен Slack (по умолчанию из переменной SLACK_TOKEN)')
+    parser.add_argument('--output', default=dirname(__file__) or '.', help='папка для выгрузки')
+    parser.add_argument('--parallel', type=int, default=CHANNELS_PARALLEL, help='сколько каналов выгружать одновременно')
+    parser.add_argument('--workers', type=int, default=WORKER_THREADS,
+                        help='потоков для обсуждений, файлов и фото юзеров')
+    parser.add_argument('--page-mode', type=parse_page_mode, default=PAGE_MODE,
+                        help="'month' - страница на месяц, N - страница на N сообщений")
+    parser.add_argument('--large-threads', choices=['inline', 'collapsed', 'page'], default=LARGE_THREADS,
+                        help=f'обсуждения длиннее {THREAD_INLINE_LIMIT} ответов: inline - как обычные, '
+                             'collapsed - свёрнутыми, page - на отдельной странице')
+    parser.add_argument('--full-sync', action='store_true',
+                        help='перечитать историю целиком, а не только последние дни: найти новые ответы '
+                             'в старых обсуждениях (само раз в FULL_SYNC_INTERVAL)')
+    parser.add_argument('--no-files', action='store_true', help='не скачивать файлы-прикрепления')
+    parser.add_argument('--no-search', action='store_true', help='не строить поисковый индекс')
+    parser.add_argument('--engine', choices=['sync', 'async'], default=ENGINE,
+                        help='async - asyncio (aiohttp или httpx) вместо потоков и requests')
+    parser.add_argument('--timezone', default=TIMEZONE,
+                        help="часовой пояс для времени сообщений ('Europe/Moscow', 'UTC'), по умолчанию - системы")
+    parser.add_argument('--jsonl', action='store_true',
+                        help='выгрузить сообщения и ответы построчно в {канал}.jsonl')
+    parser.add_argument('--parquet', action='store_true',
+                        help='выгрузить сообщения в {канал}.parquet (нужен pyarrow)')
+    parser.add_argument('--from-export', nargs='+', metavar='FILE',
+                        help='сделать html из JSONL-выгрузки ({канал}.jsonl) без запросов к Slack')
+    parser.add_argument('--verify', nargs='?', const='quick', choices=['quick', 'full'],
+                        help='только проверить хранилище файлов blobs/: quick - sha256 только у файлов с '
+                             'изменившимися размером или mtime, full - у всех. Повреждённые скачаются при выгрузке')
+    parser.add_argument('--metrics-json', help='сохранить метрики запуска в json-файл')
+    parser.add_argument('--metrics-prom', help='сохранить метрики в текстовом формате Prometheus')
+    return parser.parse_args(argv)
+
+
+# ------------------------------------------------------------------------------
+
+limiter = RateLimiter()
+metrics = Metrics()
+set_timezone(TIMEZONE)
+
+ses_users = req.Session()
+ses = req.Session()
+ses.headers.update({
+    "Content-Type": "application/x-www-form-urlencoded",
+    "Authorization": f"Bearer {TOKEN}"
+})
+
+
+def save_metrics(json_filename, prom_filename):
+    '''Метрики запуска в json и в текстовом формате Prometheus (пустое имя - не сохранять)'''
+    if json_filename:
+        with open(json_filename, 'w', encoding='utf-8') as f:
+            f.write(metrics.to_json())
+    if prom_filename:
+        with open(prom_filename, 'w', encoding='utf-8') as f:
+            f.write(metrics.to_prometheus())
+
+
+def main():
+    args = parse_args()
+    set_timezone(args.timezone)
+    formats = [fmt for fmt in ('jsonl', 'parquet') if getattr(args, fmt)]
+    # Пути из командной строки - относительно текущей папки, а не папки выгрузки
+    exports = [abspath(filename) for filename in args.from_export or ()]
+    metrics_json, metrics_prom = (abspath(filename) if filename else None
+                                  for filename in (args.metrics_json, args.metrics_prom))
+    chdir(args.output)
+    try:
+        if args.verify:
+            bad = BlobStore().verify(full=args.verify == 'full', workers=args.workers)
+            sys.exit(1 if bad else 0)
+        if exports:
+            if 'parquet' in formats and pa is None:
+                print('Для выгрузки в Parquet нужен pyarrow (pip install pyarrow) - пропускаем её')
+                formats.remove('parquet')
+            for filename in exports:
+                render_export(filename, args.page_mode, not args.no_search, formats, args.large_threads)
+            return
+        ses.headers.update({"Authorization": f"Bearer {args.token}"})
+
+        if args.all:
+            channel_ids = None
+        elif args.channels:
+            channel_ids = args.channels
+        else:
+            channel_ids = [ask_channel_id()]
+
+        channels, failed = export_channels(channel_ids, parallel=args.parallel, workers=args.workers,
+                                           page_mode=args.page_mode, download_files=not args.no_files,
+                                           types=args.types, search=not args.no_search, engine=args.engine,
+                                           formats=formats, large_threads=args.large_threads,
+                                           full_sync=args.full_sync)
+
+        # Один канал, выбранный вручную - сразу открываем
+        if not args.all and not args.channels and channels and exists(f'{channels[0].name}.html'):
+            Popen(('start', f'{channels[0].name}.html'), shell=True)
+        print('Завершено')
+        if failed:
+            sys.exit(1)
+    finally:
+        save_metrics(metrics_json, metrics_prom)
+        ses.close()
+        ses_users.close()
+
+
+if __name__ == '__main__':
+    main()